@@ -1,11 +1,21 @@
 import yaml
 import logging
-import logging.config
-import json
-from pykafka import KafkaClient
+import time
+from pykafka.common import OffsetType
+from pykafka.exceptions import KafkaException
+from pykafka.protocol import PartitionFetchRequest
+from threading import Thread
 import os
 import connexion
+from connexion.middleware import MiddlewarePosition
 from flask_cors import CORS
+from event_index import EventIndex, EVENT_TYPES
+from kafka_pool import KafkaPool
+from sse import EventStreamMiddleware, StateStream
+from metrics import MetricsMiddleware, ConsumerLag, counter, histogram
+from log_queue import configure_logging
+from leader import leader_lifespan
+import wire
 
 
 APP_CONF_FILE = ""
@@ -25,7 +35,7 @@ with open(APP_CONF_FILE, "r", encoding='utf-8') as file:
 
 with open(LOG_CONF_FILE, "r", encoding='utf-8') as file:
     LOG_CONFIG = yaml.safe_load(file.read())
-    logging.config.dictConfig(LOG_CONFIG)
+    configure_logging(LOG_CONFIG)
 
 logger = logging.getLogger('basicLogger')
 
@@ -33,88 +43,177 @@ logger.info("App Conf File: %s", APP_CONF_FILE)
 logger.info("Log Conf File: %s", LOG_CONF_FILE)
 
 
+EVENT_INDEX = EventIndex(APP_CONFIG['index']['file'])
+KAFKA_POOL = KafkaPool("%s:%d" % (APP_CONFIG['events']['hostname'], APP_CONFIG['events']['port']),
+                       APP_CONFIG['events']['topic'],
+                       APP_CONFIG['events']['retries'],
+                       APP_CONFIG['events']['retry_delay'],
+                       APP_CONFIG['events']['max_retry_delay'],
+                       APP_CONFIG['events']['max_concurrent_fetches'],
+                       APP_CONFIG['events']['health_check_interval'])
+
+EVENTS_INDEXED = counter("events_indexed_total", "Events recorded in the event index", ["event_type"])
+FETCH_TIME = histogram("kafka_fetch_duration_seconds", "Time to fetch an event from its Kafka offset")
+
+
+def event_counts():
+    """Returns the number of enroll and drop out events in History, as served by get_event_stats"""
+    return { "num_enrolls": EVENT_INDEX.count("enroll"), "num_drop_outs": EVENT_INDEX.count("drop_out") }
+
+
+# Pushes the counts that changed to dashboards subscribed to /stats/stream
+STATS_STREAM = StateStream("stats", event_counts, APP_CONFIG['stream']['interval_sec'],
+                           APP_CONFIG['stream']['queue_size'])
+
+
+def index_events():
+    """
+    Consumes the events topic in the background and records the partition
+    and offset of every enroll and drop_out event in the event index, which
+    also keeps the count of each event type. The consumer group's offsets
+    are committed periodically, but the persisted index is authoritative:
+    indexing resumes after the last offset indexed for each partition, and
+    from the earliest offset of any partition it has no entries for, such
+    as when the index file is new.
+    The consumer is restarted on the shared connection if it fails.
+
+    Returns:
+        None
+    """
+    lag = ConsumerLag("analyzer_group", APP_CONFIG['events']['lag_interval_sec'])
+    while True:
+        consumer = None
+        try:
+            topic = KAFKA_POOL.topic()
+            consumer = topic.get_simple_consumer(consumer_group=b"analyzer_group",
+                                                 reset_offset_on_start=False,
+                                                 auto_offset_reset=OffsetType.EARLIEST,
+                                                 auto_commit_enable=True,
+                                                 auto_commit_interval_ms=APP_CONFIG['events']['commit_interval_ms'])
+            # Every partition is reset so the group's committed offsets never
+            # skip events missing from the index
+            consumer.reset_offsets([(partition, EVENT_INDEX.last_offsets.get(partition_id, OffsetType.EARLIEST))
+                                    for partition_id, partition in topic.partitions.items()])
+            logger.info("Indexing events after offsets %s", EVENT_INDEX.last_offsets)
+
+            for msg in consumer:
+                try:
+                    # only the type is read, the rest of the event is decoded when fetched
+                    event_type = wire.event_type(msg.value)
+                except (ValueError, KeyError) as e:
+                    logger.error("Skipping unreadable message at offset %d: %s", msg.offset, e)
+                    continue
+
+                if event_type in EVENT_TYPES:
+                    EVENT_INDEX.append(event_type, msg.partition_id, msg.offset)
+                    EVENTS_INDEXED.inc(event_type=event_type)
+                lag.update(consumer)
+        except Exception as e:
+            logger.error("Indexer failed, reconnecting: %s", e)
+            if consumer is not None:
+                consumer.stop()
+            KAFKA_POOL.reset()
+            time.sleep(APP_CONFIG['events']['retry_delay'])
+
+
+def fetch_event(partition_id, offset):
+    """
+    Fetches the message at an offset of a partition straight from the
+    partition leader over the shared connection, without replaying the topic
+
+    Returns:
+        dict: the decoded event, or None if the message could not be fetched
+    """
+    topic = KAFKA_POOL.connected_topic()
+    partition = topic.partitions[partition_id]
+    request = PartitionFetchRequest(topic.name, partition_id, offset)
+
+    with KAFKA_POOL.fetch_slot(APP_CONFIG['events']['fetch_timeout_ms'] / 1000):
+        response = partition.leader.fetch_messages([request], timeout=APP_CONFIG['events']['fetch_timeout_ms'])
+
+    for message in response.topics[topic.name][partition_id].messages:
+        if message.offset == offset:
+            return wire.decode(message.value)
+    return None
+
+
+def get_event(event_type, index):
+    """
+    Looks up the event at an index among events of its type in the event
+    index and fetches it from its Kafka offset
+    """
+    location = EVENT_INDEX.lookup(event_type, index)
+    if location is None:
+        logger.error("Could not find %s event at index %d", event_type, index)
+        return { "message": "Not Found" }, 404
+
+    try:
+        with FETCH_TIME.time():
+            event = fetch_event(*location)
+    except TimeoutError:
+        logger.error("Too many concurrent fetches for %s event at index %d", event_type, index)
+        return { "message": "Service Unavailable" }, 503
+    except ConnectionError as e:
+        logger.error("Could not fetch %s event at index %d: %s", event_type, index, e)
+        return { "message": "Service Unavailable" }, 503
+    except ValueError as e:
+        # a malformed message, the connection is fine so it is kept
+        logger.error("Could not decode %s event at partition %d offset %d: %s", event_type, *location, e)
+        return { "message": "Event could not be decoded" }, 500
+    except (KafkaException, OSError) as e:
+        logger.error("Kafka fetch failed, reconnecting: %s", e)
+        KAFKA_POOL.reset()
+        return { "message": "Service Unavailable" }, 503
+
+    if event is None:
+        logger.error("Could not fetch %s event at partition %d offset %d", event_type, *location)
+        return { "message": "Not Found" }, 404
+
+    return event['payload'], 200
+
+
 def get_enroll_student(index):
     """Get enroll event by index in History"""
-    hostname = "%s:%d" % (APP_CONFIG['events']['hostname'],
-                          APP_CONFIG['events']['port'])
-    client = KafkaClient(hosts=hostname)
-    topic = client.topics[str.encode(APP_CONFIG['events']['topic'])]
-    consumer = topic.get_simple_consumer(reset_offset_on_start=True,
-                                         consumer_timeout_ms=1000)
     logger.info("Retrieving student enroll event at index %d", index)
-    try:
-        count = 0
-        for msg in consumer:
-            msg_str = msg.value.decode('utf-8')
-            msg = json.loads(msg_str)
-            if msg['type'] == "enroll":
-                if index == count:
-                    return msg['payload'], 200
-                else:
-                    count += 1
-    except:
-        logger.error("No more messages found")
-    logger.error("Could not find enroll event at index %d",  index)
-    return { "message": "Not Found" }, 404
+    return get_event("enroll", index)
 
 
 def get_drop_out_student(index):
     """Get drop_out event by index in History"""
-    hostname = "%s:%d" % (APP_CONFIG['events']['hostname'],
-                          APP_CONFIG['events']['port'])
-    client = KafkaClient(hosts=hostname)
-    topic = client.topics[str.encode(APP_CONFIG['events']['topic'])]
-    consumer = topic.get_simple_consumer(reset_offset_on_start=True,
-                                         consumer_timeout_ms=1000)
-    logger.info("Retrieving student enroll event at index %d", index)
-    try:
-        count = 0
-        for msg in consumer:
-            offset = msg.offset
-            msg_str = msg.value.decode('utf-8')
-            msg = json.loads(msg_str)
-            if msg['type'] == "drop_out":
-                if index == count:
-                    return msg['payload'], 200
-                else:
-                    count += 1
-    except:
-        logger.error("No more messages found")
-    logger.error("Could not find enroll event at index %d",  index)
-    return { "message": "Not Found" }, 404
+    logger.info("Retrieving student drop out event at index %d", index)
+    return get_event("drop_out", index)
 
 
 def get_event_stats():
-    """Get BP Reading in History"""
-    hostname = "%s:%d" % (APP_CONFIG['events']['hostname'],
-                          APP_CONFIG['events']['port'])
-    client = KafkaClient(hosts=hostname)
-    topic = client.topics[str.encode(APP_CONFIG['events']['topic'])]
-    consumer = topic.get_simple_consumer(reset_offset_on_start=True,
-                                         consumer_timeout_ms=1000)
-
-    logger.info("Retrieving stats")
-    num_enrolls = 0
-    num_drop_outs = 0
-    try:
-        for msg in consumer:
-            msg_str = msg.value.decode('utf-8')
-            msg = json.loads(msg_str)
-            if msg['type'] == "enroll":
-                num_enrolls += 1
-            elif msg['type'] == "drop_out":
-                num_drop_outs += 1
-    except:
-        logger.error("No more messages found")
-    logger.info("Got %d enroll events and %d drop out events", num_enrolls, num_drop_outs)
-    return { "num_enrolls": num_enrolls, "num_drop_outs": num_drop_outs }, 200
-
-app = connexion.FlaskApp(__name__, specification_dir='')
+    """
+    Get the number of enroll and drop out events in History, as counted by
+    the background indexer, without reading the topic
+    """
+    counts = event_counts()
+    logger.info("Got %d enroll events and %d drop out events", counts["num_enrolls"], counts["num_drop_outs"])
+    return counts, 200
+
+def start_background_tasks():
+    """Starts the indexer and the Kafka health checks, in one worker process only"""
+    t1 = Thread(target=index_events)
+    t1.daemon = True
+    t1.start()
+    t2 = Thread(target=KAFKA_POOL.run_health_checks)
+    t2.daemon = True
+    t2.start()
+
+app = connexion.FlaskApp(__name__, specification_dir='',
+                         lifespan=leader_lifespan(APP_CONFIG['server']['lock_file'], start_background_tasks))
 app.add_api("openapi.yaml", base_path="/analyzer", strict_validation=True, validate_responses=True)
+app.add_middleware(EventStreamMiddleware, position=MiddlewarePosition.BEFORE_EXCEPTION,
+                   path="/analyzer/stats/stream", stream=STATS_STREAM,
+                   keep_alive_sec=APP_CONFIG['stream']['keep_alive_sec'])
+app.add_middleware(MetricsMiddleware, position=MiddlewarePosition.BEFORE_EXCEPTION, path="/analyzer/metrics",
+                   shared_dir=APP_CONFIG['server']['metrics_dir'])
 
 if not "TARGET_ENV" in os.environ or os.environ['TARGET_ENV'] != "test":
     CORS(app.app)
     app.app.config['CORS_HEADERS'] = 'Content-Type'
 
 if __name__ == "__main__":
-    app.run(port=8110, host="0.0.0.0")
+    app.run(port=APP_CONFIG['server']['port'], host="0.0.0.0")
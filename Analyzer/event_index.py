@@ -0,0 +1,83 @@
+import os
+import struct
+import threading
+from array import array
+
+# event type, Kafka partition id, Kafka offset
+RECORD = struct.Struct(">Biq")
+EVENT_TYPES = ("enroll", "drop_out")
+
+
+class EventIndex:
+    """
+    Maps the ordinal of each event of a type to the Kafka partition and
+    offset holding it, so an event can be fetched with a single seek instead
+    of replaying the topic. Entries are appended to a fixed width binary log,
+    which is reloaded on start so indexing resumes after the last indexed
+    offset of each partition.
+    """
+
+    def __init__(self, filename):
+        self.filename = filename
+        self.lock = threading.Lock()
+        self.partitions = { event_type: array('i') for event_type in EVENT_TYPES }
+        self.offsets = { event_type: array('q') for event_type in EVENT_TYPES }
+        self.last_offsets = {}
+        os.makedirs(os.path.dirname(filename) or ".", exist_ok=True)
+        self.load()
+        self.file = open(filename, 'ab')
+
+    def load(self):
+        """Loads the persisted entries, dropping a partially written last entry"""
+        if not os.path.isfile(self.filename):
+            return
+
+        with open(self.filename, 'rb') as file:
+            data = file.read()
+
+        complete = len(data) - len(data) % RECORD.size
+        for type_id, partition_id, offset in RECORD.iter_unpack(data[:complete]):
+            self.add(EVENT_TYPES[type_id], partition_id, offset)
+
+        if complete < len(data):
+            with open(self.filename, 'r+b') as file:
+                file.truncate(complete)
+
+    def add(self, event_type, partition_id, offset):
+        self.partitions[event_type].append(partition_id)
+        self.offsets[event_type].append(offset)
+        self.last_offsets[partition_id] = max(offset, self.last_offsets.get(partition_id, -1))
+
+    def append(self, event_type, partition_id, offset):
+        """
+        Indexes an event as the next event of its type and persists the entry
+
+        args:
+            string event_type: "enroll" or "drop_out"
+            int partition_id: the Kafka partition holding the event
+            int offset: the offset of the event in the partition
+        """
+        with self.lock:
+            self.file.write(RECORD.pack(EVENT_TYPES.index(event_type), partition_id, offset))
+            self.file.flush()
+            self.add(event_type, partition_id, offset)
+
+    def lookup(self, event_type, index):
+        """
+        Finds the event at an ordinal of its type
+
+        args:
+            string event_type: "enroll" or "drop_out"
+            int index: the ordinal of the event among events of its type
+
+        returns:
+            tuple: the (partition id, offset) of the event, or None if not indexed
+        """
+        with self.lock:
+            if not 0 <= index < len(self.offsets[event_type]):
+                return None
+            return self.partitions[event_type][index], self.offsets[event_type][index]
+
+    def count(self, event_type):
+        """Returns the number of indexed events of a type"""
+        return len(self.offsets[event_type])
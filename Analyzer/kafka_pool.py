@@ -0,0 +1,138 @@
+import logging
+import threading
+import time
+from contextlib import contextmanager
+
+from pykafka import KafkaClient
+
+logger = logging.getLogger('basicLogger')
+
+
+def close_client(client):
+    """
+    Stops the request handler threads and closes the sockets a KafkaClient
+    opened to each broker. pykafka has no public close, so this reaches into
+    the brokers' handlers and connections.
+    """
+    for broker in client.brokers.values():
+        for handler in (broker._req_handler, broker._offsets_channel_req_handler):
+            if handler is not None:
+                handler.stop()
+        for connection in (broker._connection, broker._offsets_channel_connection):
+            if connection is not None:
+                connection.disconnect()
+
+
+class KafkaPool:
+    """
+    Process-wide Kafka client shared by the Analyzer's background indexer
+    and request handlers. The connection is made once and reused, checked
+    periodically by refreshing the cluster metadata, and replaced with
+    exponential backoff when it fails. Fetches are bounded so bursts of
+    requests queue for a slot instead of piling requests onto the broker.
+    """
+
+    def __init__(self, hosts, topic_name, retries, retry_delay, max_retry_delay,
+                 max_concurrent_fetches, health_check_interval):
+        self.hosts = hosts
+        self.topic_name = topic_name
+        self.retries = retries
+        self.retry_delay = retry_delay
+        self.max_retry_delay = max_retry_delay
+        self.health_check_interval = health_check_interval
+        self.lock = threading.Lock()
+        self.fetch_slots = threading.BoundedSemaphore(max_concurrent_fetches)
+        self.client = None
+        self._topic = None
+
+    def topic(self):
+        """
+        Returns the shared topic, connecting first if there is no connection
+
+        Raises:
+            ConnectionRefusedError: If unable to connect to the Kafka broker after the configured retries
+        """
+        with self.lock:
+            if self._topic is None:
+                self.connect()
+            return self._topic
+
+    def connected_topic(self):
+        """
+        Returns the shared topic without waiting for a connection, for
+        request handlers that should fail fast while Kafka is down
+
+        Raises:
+            ConnectionError: If there is no connection to the Kafka broker
+        """
+        topic = self._topic
+        if topic is None:
+            raise ConnectionError("Not connected to Kafka Broker")
+        return topic
+
+    def connect(self):
+        """Connects to the Kafka broker, backing off exponentially between retries"""
+        delay = self.retry_delay
+        for current_retry in range(self.retries + 1):
+            try:
+                logger.info("Retry %d of connecting to Kafka broker", current_retry)
+                self.client = KafkaClient(hosts=self.hosts)
+                self._topic = self.client.topics[str.encode(self.topic_name)]
+                logger.info("Successfully connected to Kafka broker")
+                return
+            except Exception as e:
+                logger.error("Error: %s", e)
+                self.client = None
+                time.sleep(delay)
+                delay = min(delay * 2, self.max_retry_delay)
+        raise ConnectionRefusedError("Could not connect to Kafka Broker")
+
+    def reset(self):
+        """Closes the connection so the next use of the topic reconnects"""
+        with self.lock:
+            if self.client is not None:
+                try:
+                    close_client(self.client)
+                except Exception as e:
+                    logger.error("Error closing Kafka client: %s", e)
+            self.client = None
+            self._topic = None
+
+    def check_health(self):
+        """
+        Refreshes the cluster metadata, dropping the connection if it fails
+
+        Returns:
+            bool: whether the connection is healthy
+        """
+        client = self.client
+        if client is None:
+            return False
+        try:
+            client.update_cluster()
+            return True
+        except Exception as e:
+            logger.error("Kafka health check failed: %s", e)
+            self.reset()
+            return False
+
+    def run_health_checks(self):
+        """Checks the connection every health_check_interval seconds"""
+        while True:
+            time.sleep(self.health_check_interval)
+            self.check_health()
+
+    @contextmanager
+    def fetch_slot(self, timeout):
+        """
+        Holds one of the bounded fetch slots for the duration of a fetch
+
+        Raises:
+            TimeoutError: If no slot frees up within timeout seconds
+        """
+        if not self.fetch_slots.acquire(timeout=timeout):
+            raise TimeoutError("No Kafka fetch slot available")
+        try:
+            yield
+        finally:
+            self.fetch_slots.release()
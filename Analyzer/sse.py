@@ -0,0 +1,194 @@
+import asyncio
+import json
+import logging
+import threading
+import time
+
+from metrics import gauge
+
+logger = logging.getLogger('basicLogger')
+
+SSE_SUBSCRIBERS = gauge("sse_subscribers", "Clients subscribed to each server-sent event stream", ["path"])
+
+
+def format_event(event, data):
+    """Encodes an event in the text/event-stream format"""
+    return f"event: {event}\ndata: {json.dumps(data)}\n\n".encode('utf-8')
+
+
+class EventStream:
+    """
+    Fans out events published by background threads, such as a Kafka
+    consumer, to every client subscribed over HTTP. Each event is encoded
+    once and queued for each subscriber on its event loop. A subscriber
+    that falls queue_size events behind is disconnected rather than
+    buffered without bound; its EventSource reconnects and starts over
+    from the initial events.
+    """
+
+    def __init__(self, initial=None, queue_size=100):
+        """
+        args:
+            function initial: returns the (event, data) pairs sent to a new
+                subscriber before the live events, such as the latest state
+            int queue_size: the most events queued for a subscriber
+        """
+        self.initial_events = initial
+        self.queue_size = queue_size
+        self.lock = threading.Lock()
+        self.subscribers = {}
+
+    def initial(self):
+        return self.initial_events() if self.initial_events is not None else []
+
+    def subscribe(self):
+        """
+        Subscribes the calling event loop to the stream
+
+        returns:
+            asyncio.Queue: the encoded events for the subscriber, starting with
+            the initial events, and None once it should be disconnected
+        """
+        queue = asyncio.Queue(self.queue_size)
+        with self.lock:
+            for event, data in self.initial():
+                queue.put_nowait(format_event(event, data))
+            self.subscribers[queue] = asyncio.get_running_loop()
+        return queue
+
+    def unsubscribe(self, queue):
+        with self.lock:
+            self.subscribers.pop(queue, None)
+
+    def publish(self, event, data):
+        """Sends an event to every subscriber, from any thread"""
+        message = format_event(event, data)
+        with self.lock:
+            subscribers = list(self.subscribers.items())
+        for queue, loop in subscribers:
+            loop.call_soon_threadsafe(self.offer, queue, message)
+
+    @staticmethod
+    def offer(queue, message):
+        try:
+            queue.put_nowait(message)
+        except asyncio.QueueFull:
+            while not queue.empty():
+                queue.get_nowait()
+            queue.put_nowait(None)
+
+
+class StateStream(EventStream):
+    """
+    Streams a JSON object that changes over time, such as the latest stats.
+    New subscribers get the whole object, then only the fields that changed.
+    While anyone is subscribed, a thread checks get_state for changes every
+    interval seconds, so the cost of the stream does not grow with the number
+    of subscribers.
+    """
+
+    def __init__(self, event, get_state, interval, queue_size=100):
+        super().__init__(queue_size=queue_size)
+        self.event = event
+        self.get_state = get_state
+        self.interval = interval
+        self.state = None
+        self.watcher = None
+
+    def initial(self):
+        # self.state stays the last published state, which the current
+        # subscribers have, and is only set here for the first subscriber
+        state = self.get_state()
+        if self.state is None:
+            self.state = state
+        return [(self.event, state)]
+
+    def subscribe(self):
+        queue = super().subscribe()
+        with self.lock:
+            if self.watcher is None:
+                self.watcher = threading.Thread(target=self.watch, daemon=True)
+                self.watcher.start()
+        return queue
+
+    def watch(self):
+        while True:
+            time.sleep(self.interval)
+            with self.lock:
+                if not self.subscribers:
+                    continue
+                try:
+                    state = self.get_state()
+                except Exception as e:
+                    logger.error("Could not read the state of the %s stream: %s", self.event, e)
+                    continue
+                previous = self.state or {}
+                delta = { key: value for key, value in state.items() if previous.get(key) != value }
+                self.state = state
+            if delta:
+                self.publish(self.event, delta)
+
+
+class EventStreamMiddleware:
+    """
+    ASGI middleware for a connexion app that serves an EventStream as
+    server-sent events at path. Streams are served on the event loop rather
+    than by a Flask handler, so open connections do not hold one of the few
+    threads that run Flask. Add it before the metrics middleware so the
+    request latency histogram is not skewed by long-lived streams:
+
+        app.add_middleware(EventStreamMiddleware, position=MiddlewarePosition.BEFORE_EXCEPTION,
+                           path="/processing/stats/stream", stream=STATS_STREAM)
+    """
+
+    def __init__(self, app, path, stream, keep_alive_sec=15):
+        self.app = app
+        self.path = path
+        self.stream = stream
+        self.keep_alive_sec = keep_alive_sec
+
+    async def __call__(self, scope, receive, send):
+        if scope["type"] != "http" or scope["path"] != self.path:
+            await self.app(scope, receive, send)
+            return
+
+        await send({
+            "type": "http.response.start",
+            "status": 200,
+            "headers": [(b"content-type", b"text/event-stream"),
+                        (b"cache-control", b"no-cache"),
+                        (b"access-control-allow-origin", b"*"),
+                        # stop nginx from buffering the stream
+                        (b"x-accel-buffering", b"no")]
+        })
+
+        queue = self.stream.subscribe()
+        SSE_SUBSCRIBERS.set(len(self.stream.subscribers), path=self.path)
+        disconnected = asyncio.ensure_future(self.wait_for_disconnect(receive))
+        next_message = asyncio.ensure_future(queue.get())
+        try:
+            while True:
+                done, _ = await asyncio.wait({next_message, disconnected}, timeout=self.keep_alive_sec,
+                                             return_when=asyncio.FIRST_COMPLETED)
+                if disconnected in done:
+                    break
+                if next_message in done:
+                    message = next_message.result()
+                    if message is None:
+                        break
+                    next_message = asyncio.ensure_future(queue.get())
+                else:
+                    # a comment keeps idle connections open through proxies
+                    message = b": keep-alive\n\n"
+                await send({ "type": "http.response.body", "body": message, "more_body": True })
+            await send({ "type": "http.response.body", "body": b"" })
+        finally:
+            next_message.cancel()
+            disconnected.cancel()
+            self.stream.unsubscribe(queue)
+            SSE_SUBSCRIBERS.set(len(self.stream.subscribers), path=self.path)
+
+    @staticmethod
+    async def wait_for_disconnect(receive):
+        while (await receive())["type"] != "http.disconnect":
+            pass
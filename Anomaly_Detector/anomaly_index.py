@@ -0,0 +1,110 @@
+import threading
+from bisect import bisect_left
+
+
+class AnomalyIndex:
+    """
+    In-memory secondary indexes of the stored anomalies by anomaly type and
+    by event type. Each anomaly gets an increasing sequence number, and since
+    anomalies are timestamped when detected and indexed as they are stored,
+    each index is a time ordered list of sequence numbers. A page of the
+    newest anomalies is read by walking an index backwards from a cursor, so
+    a query costs O(page) rather than a filter and sort of every anomaly.
+    """
+
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.first_seq = 0
+        self.anomalies = []
+        self.by_anomaly_type = {}
+        self.by_event_type = {}
+
+    @staticmethod
+    def anomaly_type_key(anomaly_type):
+        """Normalizes an anomaly type, so "Too High" and "TooHigh" match"""
+        return anomaly_type.replace(' ', '')
+
+    def add(self, anomaly):
+        """
+        Indexes an anomaly as the newest anomaly
+
+        returns:
+            int: the sequence number of the anomaly
+        """
+        with self.lock:
+            seq = self.first_seq + len(self.anomalies)
+            self.anomalies.append(anomaly)
+            self.by_anomaly_type.setdefault(self.anomaly_type_key(anomaly['anomaly_type']), []).append(seq)
+            self.by_event_type.setdefault(anomaly['event_type'], []).append(seq)
+            return seq
+
+    def rebuild(self, anomalies):
+        """
+        Replaces the indexed anomalies with the newest ones kept by a
+        compaction, keeping their sequence numbers so cursors stay valid.
+        The new indexes are built aside and swapped in at once, so queries
+        meanwhile see the old anomalies rather than a partial index. The
+        caller must not add anomalies until the rebuild returns.
+        """
+        with self.lock:
+            first_seq = self.first_seq + len(self.anomalies) - len(anomalies)
+
+        by_anomaly_type = {}
+        by_event_type = {}
+        for seq, anomaly in enumerate(anomalies, first_seq):
+            by_anomaly_type.setdefault(self.anomaly_type_key(anomaly['anomaly_type']), []).append(seq)
+            by_event_type.setdefault(anomaly['event_type'], []).append(seq)
+
+        with self.lock:
+            self.first_seq = first_seq
+            self.anomalies = list(anomalies)
+            self.by_anomaly_type = by_anomaly_type
+            self.by_event_type = by_event_type
+
+    def anomaly_types(self):
+        """Returns the normalized anomaly types indexed so far"""
+        with self.lock:
+            return list(self.by_anomaly_type)
+
+    def __len__(self):
+        return len(self.anomalies)
+
+    def query(self, anomaly_type=None, event_type=None, limit=None, since=None, cursor=None):
+        """
+        Finds the newest anomalies matching the given filters
+
+        args:
+            string anomaly_type: only return anomalies of this type, such as "TooHigh"
+            string event_type: only return anomalies of this event type, such as "enroll"
+            int limit: the most anomalies to return
+            string since: only return anomalies detected after this timestamp
+            int cursor: only return anomalies older than this sequence number
+
+        returns:
+            list: the matching anomalies, from newest to oldest
+            int: the cursor of the next page, or None if there are no more anomalies
+        """
+        with self.lock:
+            if anomaly_type is not None:
+                seqs = self.by_anomaly_type.get(self.anomaly_type_key(anomaly_type), [])
+            elif event_type is not None:
+                seqs = self.by_event_type.get(event_type, [])
+            else:
+                seqs = range(self.first_seq, self.first_seq + len(self.anomalies))
+
+            end = len(seqs) if cursor is None else bisect_left(seqs, cursor)
+            results = []
+            seq = None
+            for position in range(end - 1, -1, -1):
+                if limit is not None and len(results) == limit:
+                    return results, seq
+
+                seq = seqs[position]
+                anomaly = self.anomalies[seq - self.first_seq]
+                if since is not None and anomaly['timestamp'] <= since:
+                    break
+                if event_type is not None and anomaly['event_type'] != event_type:
+                    continue
+                results.append(anomaly)
+
+            return results, None
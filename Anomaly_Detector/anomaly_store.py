@@ -0,0 +1,229 @@
+import json
+import logging
+import os
+import threading
+import time
+
+from anomaly_index import AnomalyIndex
+
+logger = logging.getLogger('basicLogger')
+
+
+class AnomalyStore:
+    """
+    Append-only store of anomalies in newline delimited JSON segment files.
+
+    Each anomaly is appended to the active segment as one line and fsynced,
+    so a write costs the same however many anomalies are stored, and a crash
+    can at worst leave a partial last line, which is dropped on load. Once
+    the active segment reaches segment_max_bytes a new one is started.
+    Compaction rewrites the newest retention_count anomalies into a single
+    segment, named as compacted, and deletes the older segments, so the
+    store stays bounded.
+    The stored anomalies are also kept in an AnomalyIndex for queries.
+    """
+
+    def __init__(self, directory, segment_max_bytes, retention_count):
+        self.directory = directory
+        self.segment_max_bytes = segment_max_bytes
+        self.retention_count = retention_count
+        self.lock = threading.Lock()
+
+        os.makedirs(directory, exist_ok=True)
+        self.segments = self.load_segments()
+        if not self.segments:
+            self.segments.append(self.segment_name(1))
+
+        self.count = 0
+        for segment in self.segments:
+            self.count += self.repair(self.path(segment))
+
+        self.active = open(self.path(self.segments[-1]), 'a', encoding='utf-8')
+
+        self.index = AnomalyIndex()
+        for anomaly in self:
+            self.index.add(anomaly)
+
+    @staticmethod
+    def segment_name(sequence, compacted=False):
+        return "%08d.compacted.ndjson" % sequence if compacted else "%08d.ndjson" % sequence
+
+    @staticmethod
+    def sequence(segment):
+        return int(segment.split(".")[0])
+
+    def load_segments(self):
+        """
+        Lists the segments to load, oldest first. A compacted segment holds
+        everything kept from the segments numbered below it, so any of those
+        left by a compaction interrupted before it deleted them are removed,
+        as are the temporary files of a compaction interrupted before its
+        segment was published.
+
+        Returns:
+            list: the names of the segments
+        """
+        names = os.listdir(self.directory)
+        for name in names:
+            if name.endswith(".ndjson.tmp"):
+                logger.warning("Removing %s left by an interrupted compaction", name)
+                os.remove(self.path(name))
+
+        segments = sorted((name for name in names if name.endswith(".ndjson")), key=self.sequence)
+        compacted = [segment for segment in segments if segment.endswith(".compacted.ndjson")]
+        if not compacted:
+            return segments
+
+        base = self.sequence(compacted[-1])
+        for segment in segments:
+            if self.sequence(segment) < base:
+                logger.warning("Removing %s, already compacted into %s", segment, compacted[-1])
+                os.remove(self.path(segment))
+        return [segment for segment in segments if self.sequence(segment) >= base]
+
+    def path(self, segment):
+        return os.path.join(self.directory, segment)
+
+    def repair(self, path):
+        """
+        Truncates a partially written last line from a segment
+
+        Returns:
+            int: the number of complete anomalies in the segment
+        """
+        if not os.path.isfile(path):
+            return 0
+
+        with open(path, 'rb') as f:
+            data = f.read()
+
+        complete = data.rfind(b"\n") + 1
+        if complete < len(data):
+            logger.warning("Dropping partial anomaly at the end of %s", path)
+            with open(path, 'r+b') as f:
+                f.truncate(complete)
+
+        return data.count(b"\n", 0, complete)
+
+    def append(self, anomaly):
+        """
+        Durably appends an anomaly to the active segment. If the write fails,
+        any part of the line already written is truncated, so the append can
+        be retried.
+        """
+        line = json.dumps(anomaly) + "\n"
+        with self.lock:
+            if self.active.closed:
+                self.active = open(self.path(self.segments[-1]), 'a', encoding='utf-8')
+            position = self.active.tell()
+            try:
+                self.active.write(line)
+                self.active.flush()
+                os.fsync(self.active.fileno())
+            except OSError:
+                self.truncate_active(position)
+                raise
+            self.count += 1
+            self.index.add(anomaly)
+
+            if self.active.tell() >= self.segment_max_bytes:
+                self.roll()
+
+    def truncate_active(self, position):
+        """Drops anything written to the active segment after position"""
+        try:
+            self.active.close()
+        except OSError:
+            # The buffered part of the line that failed is discarded
+            pass
+        self.active = open(self.path(self.segments[-1]), 'a', encoding='utf-8')
+        self.active.truncate(position)
+
+    def roll(self):
+        """Closes the active segment and starts a new one"""
+        self.active.close()
+        self.segments.append(self.segment_name(self.sequence(self.segments[-1]) + 1))
+        self.active = open(self.path(self.segments[-1]), 'a', encoding='utf-8')
+
+    def __iter__(self):
+        """Yields the stored anomalies from oldest to newest"""
+        with self.lock:
+            segments = list(self.segments)
+            end = self.active.tell()
+
+        for segment in segments:
+            with open(self.path(segment), 'rb') as f:
+                # Only read what was complete when iteration started, since
+                # the active segment may be appended to meanwhile
+                data = f.read(end) if segment == segments[-1] else f.read()
+            for line in data.splitlines():
+                yield json.loads(line)
+
+    def compact(self):
+        """
+        Rewrites the newest retention_count anomalies into one segment and
+        deletes the older segments. The compacted segment is written to a
+        temporary file and renamed into place, so a crash before the rename
+        leaves the old segments, and a crash after it leaves the compacted
+        segment, along with any old segments not deleted yet, which the next
+        load removes as they are numbered below it.
+        """
+        with self.lock:
+            if self.count <= self.retention_count and len(self.segments) <= 2:
+                return
+
+            lines = []
+            for segment in self.segments:
+                with open(self.path(segment), 'r', encoding='utf-8') as f:
+                    lines.extend(f)
+            lines = lines[-self.retention_count:]
+
+            self.active.close()
+            compacted = self.segment_name(self.sequence(self.segments[-1]) + 1, compacted=True)
+            temp_path = self.path(compacted + ".tmp")
+            with open(temp_path, 'w', encoding='utf-8') as f:
+                f.writelines(lines)
+                f.flush()
+                os.fsync(f.fileno())
+            os.replace(temp_path, self.path(compacted))
+            # The rename must be durable before the old segments go
+            directory_fd = os.open(self.directory, os.O_RDONLY)
+            try:
+                os.fsync(directory_fd)
+            finally:
+                os.close(directory_fd)
+
+            for segment in self.segments:
+                os.remove(self.path(segment))
+
+            logger.info("Compacted %d anomalies into %s, kept %d", self.count, compacted, len(lines))
+            self.segments = [compacted]
+            self.count = len(lines)
+            self.roll()
+            self.index.rebuild([json.loads(line) for line in lines])
+
+    def run_compaction(self, interval):
+        """Compacts the store every interval seconds"""
+        while True:
+            time.sleep(interval)
+            try:
+                self.compact()
+            except Exception as e:
+                logger.error("Error compacting anomalies: %s", e)
+
+    def import_legacy(self, filename):
+        """
+        Appends the anomalies of a legacy JSON list file to the store once,
+        oldest first, then renames the file so it is not imported again
+        """
+        if not os.path.isfile(filename):
+            return
+
+        with open(filename, 'r') as f:
+            anomalies = sorted(json.load(f), key=lambda anomaly: anomaly['timestamp'])
+
+        for anomaly in anomalies:
+            self.append(anomaly)
+
+        os.replace(filename, filename + ".imported")
+        logger.info("Imported %d anomalies from %s", len(anomalies), filename)
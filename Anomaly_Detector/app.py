@@ -1,50 +1,85 @@
 import connexion
 from connexion import NoContent
+from connexion.middleware import MiddlewarePosition
 from datetime import datetime
 import time
 
 import yaml
 import logging
-import logging.config
-import json
 import os
 
 from pykafka import KafkaClient
 from pykafka.common import OffsetType
 from threading import Thread
 
+from anomaly_store import AnomalyStore
+from rules import RuleEngine
+from metrics import MetricsMiddleware, ConsumerLag, counter, histogram
+from log_queue import configure_logging
+from leader import leader_lifespan
+from sse import EventStream, EventStreamMiddleware
+import wire
+
 
 app_conf_file = ""
 log_conf_file = ""
+rules_file = ""
 
 if "TARGET_ENV" in os.environ and os.environ["TARGET_ENV"] == "test":
         print("In test environment")
         app_conf_file = "/config/app_conf.yml"
         log_conf_file = "/config/log_conf.yml"
+        rules_file = "/config/rules.yml"
 else:
         print("In Dev Environment")
         app_conf_file = "app_conf.yml"
         log_conf_file = "log_conf.yml"
+        rules_file = "rules.yml"
 
 with open(app_conf_file, 'r') as f:
     app_config = yaml.safe_load(f.read())
 
 with open(log_conf_file, 'r') as f:
     log_config = yaml.safe_load(f.read())
-    logging.config.dictConfig(log_config)
+    configure_logging(log_config)
 
 logger = logging.getLogger('basicLogger')
-
-if not os.path.isfile(app_config['store']['file']):
-    with open(app_config['store']['file'], 'w') as f:
-        json.dump([], f)
+# Per-event payloads, sampled by the payload_sample filter of log_conf.yml
+payload_logger = logging.getLogger('basicLogger.payload')
+
+anomaly_store = AnomalyStore(app_config['store']['dir'],
+                             app_config['store']['segment_max_bytes'],
+                             app_config['store']['retention_count'])
+anomaly_store.import_legacy(app_config['store']['file'])
+
+rule_engine = RuleEngine(rules_file, app_config['rules']['reload_interval'])
+
+def latest_anomalies():
+    """Returns the newest anomaly of each anomaly type, as (anomaly type, anomaly) pairs"""
+    latest = []
+    for anomaly_type in anomaly_store.index.anomaly_types():
+        anomalies, _ = anomaly_store.index.query(anomaly_type=anomaly_type, limit=1)
+        latest.extend((anomaly_type, anomaly) for anomaly in anomalies)
+    return latest
+
+# Pushes each new anomaly to dashboards subscribed to /anomalies/stream, as
+# an event named after its anomaly type such as "TooHigh"
+ANOMALY_STREAM = EventStream(latest_anomalies, app_config['stream']['queue_size'])
+
+BATCH_SIZE = histogram("consumer_batch_size", "Number of Kafka messages in each checked batch",
+                       buckets=(1, 5, 10, 25, 50, 100, 250, 500, 1000))
+RULES_TIME = histogram("rule_evaluation_duration_seconds", "Time to check a batch against every rule")
+ANOMALIES_DETECTED = counter("anomalies_detected_total", "Anomalies appended to the anomaly store",
+                             ["event_type", "anomaly_type"])
 
 def connect_to_broker():
     """
-    Connects to the Kafka broker specified in the app_config.yml file
+    Connects to the Kafka broker specified in the app_config.yml file and
+    joins the balanced anomaly_group consumer group, in which Kafka assigns
+    each member a share of the topic's partitions
 
     Returns:
-        object: a simple consumer Kafka instance
+        object: a balanced consumer Kafka instance
 
     Raises:
         ConnectionRefusedError: If unable to connect to Kafka broker after 5 tries
@@ -59,9 +94,12 @@ def connect_to_broker():
             logger.info("retry %s of connecting to kafka broker", current_retry)
             client = KafkaClient(hosts=hostname)
             topic = client.topics[str.encode(app_config['events']['topic'])]
-            consumer = topic.get_simple_consumer(consumer_group=b"anomaly_group",
-                                                reset_offset_on_start=False,
-                                                auto_offset_reset=OffsetType.LATEST)
+            consumer = topic.get_balanced_consumer(consumer_group=b"anomaly_group",
+                                                   managed=True,
+                                                   auto_commit_enable=False,
+                                                   reset_offset_on_start=False,
+                                                   auto_offset_reset=OffsetType.LATEST,
+                                                   consumer_timeout_ms=app_config['events']['batch']['max_linger_ms'])
             logger.info("Successfully connected to Kafka broker")
             return consumer
         except Exception as e:
@@ -70,108 +108,140 @@ def connect_to_broker():
             current_retry += 1
     raise ConnectionRefusedError("Could not connect to Kafka Broker")
 
+def detect_anomalies(batch):
+    """
+    Checks a batch of kafka messages against the anomaly rules and appends
+    any anomalies found to the anomaly store. The batch is checked once, and
+    an append that fails, such as for a full disk, is retried until it
+    succeeds, so the offsets of the batch are only committed once all of its
+    anomalies are stored.
+
+    :param list batch: the kafka messages in the batch
+
+    Returns:
+        None
+    """
+    events = []
+    for msg in batch:
+        try:
+            event = wire.decode(msg.value)
+            payload_logger.debug("Message: %s", event)
+            events.append(event)
+        except ValueError as e:
+            logger.error("Skipping malformed message: %s" % e)
+
+    BATCH_SIZE.observe(len(batch))
+    with RULES_TIME.time():
+        anomalies = rule_engine.evaluate(events)
+
+    for anomaly in anomalies:
+        while True:
+            try:
+                anomaly_store.append(anomaly)
+                break
+            except Exception as e:
+                logger.error("Failed to store anomaly, retrying: %s", e)
+                time.sleep(app_config['events']['retry_delay'])
+        ANOMALIES_DETECTED.inc(event_type=anomaly['event_type'], anomaly_type=anomaly['anomaly_type'])
+        ANOMALY_STREAM.publish(anomaly_store.index.anomaly_type_key(anomaly['anomaly_type']), anomaly)
+        logger.info("Anomaly added to database: %s" % anomaly)
+
 def get_events():
     """
-    Consumes all kafka messages and checks for any anomalies
-    to add to the JSON datastore
+    Consumes kafka messages in micro-batches and checks them for anomalies
+    to append to the anomaly store. A batch is checked once it reaches the
+    configured max size, once its oldest message has waited max linger ms,
+    or when the topic goes idle. The rules are reloaded between batches
+    when the rules file changes. Several of these run as workers of the
+    consumer group; events are keyed by student_id, so the events of a
+    student are all checked by one worker, in order.
 
     Returns:
         None
     """
-    with open(app_config['store']['file'], 'r') as f:
-        current_anomalies = json.load(f)
-    
     consumer = connect_to_broker()
-
-    for msg in consumer:
-        msg_str = msg.value.decode('utf-8')
-        logger.info("Message: %s" % msg_str)
-        msg = json.loads(msg_str)
-    
-        try:
-            payload = msg['payload']
-            enroll_threshold = app_config['thresholds']['enroll']
-            drop_out_threshold = app_config['thresholds']['drop_out']
-            if msg['type'] == "enroll" and payload['highschool_gpa'] > enroll_threshold:
-                anomaly = {
-                    "event_id": payload['student_id'],
-                    "trace_id": payload['trace_id'],
-                    "event_type": "enroll",
-                    "anomaly_type": "Too High",
-                    "description": f"High School GPA {payload['highschool_gpa']} is above {enroll_threshold}",
-                    "timestamp": datetime.strftime(datetime.now(), "%Y-%m-%d %H:%M:%S")
-                }
-                current_anomalies.append(anomaly)
-
-                with open(app_config['store']['file'], "w") as f:
-                    json.dump(current_anomalies, f, indent=4)
-                    
-                logger.info("Anomaly added to database: %s" % anomaly)
-                
-            elif msg['type'] == "drop_out" and payload['program_gpa'] < drop_out_threshold:
-                anomaly = {
-                    "event_id": payload['student_id'],
-                    "trace_id": payload['trace_id'],
-                    "event_type": "drop_out",
-                    "anomaly_type": "Too Low",
-                    "description": f"Program GPA {payload['program_gpa']} is below {drop_out_threshold}",
-                    "timestamp": datetime.strftime(datetime.now(), "%Y-%m-%d %H:%M:%S")
-                }
-                current_anomalies.append(anomaly)
-                
-                with open(app_config['store']['file'], "w") as f:
-                    json.dump(current_anomalies, f, indent=4)
-
-                logger.info("Anomaly added to database: %s" % anomaly)
-                
-            consumer.commit_offsets()
-        except Exception as e:
-            logger.error(f"Error: {e}")
-        
-def get_anomalies(anomaly_type):
+    max_batch_size = app_config['events']['batch']['max_size']
+    max_linger_ms = app_config['events']['batch']['max_linger_ms']
+
+    lag = ConsumerLag("anomaly_group", app_config['events']['lag_interval_sec'])
+    batch = []
+    batch_deadline = None
+    while True:
+        rule_engine.reload_if_due(time.monotonic())
+        msg = consumer.consume()
+        lag.update(consumer)
+
+        if msg is not None:
+            batch.append(msg)
+            if batch_deadline is None:
+                batch_deadline = time.monotonic() + max_linger_ms / 1000
+
+        if not batch:
+            continue
+
+        if (msg is None or len(batch) >= max_batch_size
+                or time.monotonic() >= batch_deadline):
+            detect_anomalies(batch)
+            try:
+                consumer.commit_offsets()
+            except Exception as e:
+                # The batch is consumed again after a restart or rebalance,
+                # so it is checked at least once
+                logger.error(f"Error: {e}")
+            batch = []
+            batch_deadline = None
+
+def get_anomalies(anomaly_type=None, event_type=None, limit=None, since=None, cursor=None):
     """
     Runs when a GET request is sent to the /anomalies endpoint
-    Retrieves all anomalies by the anomaly type requested
+    Retrieves a page of the newest anomalies matching the filters requested
     
     :param string anomaly_type: the type of anomaly
+    :param string event_type: the type of event the anomaly was detected in
+    :param int limit: the most anomalies to return
+    :param string since: only return anomalies detected after this timestamp
+    :param int cursor: resumes after the last anomaly of the previous page
 
     Returns:
-        list: A list of anomaly objects that match the anomaly type requested
-        int: Status code 200 if the anomalies are retrieved successfully
+        list: A list of anomaly objects that match the filters requested, from newest to oldest
+        int: Status code 200 if the anomalies are retrieved successfully, 400 if since is invalid
+        dict: The X-Next-Cursor header when more anomalies may remain
     """
-    try:
-        logger.debug("Received request for anomaly type %s" % anomaly_type)
-
-        with open(app_config['store']['file'], 'r') as f:
-            current_anomalies = json.load(f)
-
-        requested_anomalies = []
-
-        for event in current_anomalies:
-            if event['anomaly_type'].replace(' ', '') == anomaly_type:
-                requested_anomalies.append(event)
+    logger.debug("Received request for anomaly type %s" % anomaly_type)
 
-        requested_anomalies = sorted(requested_anomalies, key=sort_by_date, reverse=True)
-
-        logger.info("Anomalies returned: %s" % requested_anomalies)
-
-        return requested_anomalies, 200
-    except Exception as e:
-        logger.error("Error: %s" % e)
-
-def sort_by_date(event):
-    return datetime.strptime(event['timestamp'], "%Y-%m-%d %H:%M:%S")
-
-app = connexion.FlaskApp(__name__, specification_dir="")
+    if since is not None:
+        try:
+            datetime.strptime(since, "%Y-%m-%d %H:%M:%S")
+        except ValueError:
+            return { "message": "since must be formatted as YYYY-MM-DD HH:MM:SS" }, 400
+
+    requested_anomalies, next_cursor = anomaly_store.index.query(anomaly_type, event_type, limit, since, cursor)
+
+    logger.info("Returned %d anomalies" % len(requested_anomalies))
+
+    headers = {}
+    if next_cursor is not None:
+        headers["X-Next-Cursor"] = str(next_cursor)
+    return requested_anomalies, 200, headers
+
+def start_background_tasks():
+    """Starts the Kafka consumer workers and the compaction of the anomaly store, in one worker process only"""
+    for _ in range(app_config['events']['consumer_workers']):
+        t1 = Thread(target=get_events)
+        t1.daemon = True
+        t1.start()
+    t2 = Thread(target=anomaly_store.run_compaction, args=(app_config['store']['compaction_interval'],))
+    t2.daemon = True
+    t2.start()
+
+app = connexion.FlaskApp(__name__, specification_dir="",
+                         lifespan=leader_lifespan(app_config['server']['lock_file'], start_background_tasks))
 app.add_api('openapi.yaml', base_path="/anomalies", strict_validation=True, validate_responses=True)
+app.add_middleware(EventStreamMiddleware, position=MiddlewarePosition.BEFORE_EXCEPTION,
+                   path="/anomalies/anomalies/stream", stream=ANOMALY_STREAM,
+                   keep_alive_sec=app_config['stream']['keep_alive_sec'])
+app.add_middleware(MetricsMiddleware, position=MiddlewarePosition.BEFORE_EXCEPTION, path="/anomalies/metrics",
+                   shared_dir=app_config['server']['metrics_dir'])
 
 if __name__ == "__main__":
-    t1 = Thread(target=get_events)
-    t1.daemon = True
-    t1.start()
-    app.run(port=8120, host="0.0.0.0")
-
-    logger.info("Threshold of enroll High School GPA: Higher than %s", 
-                app_config['thresholds']['enroll'])
-    logger.info("Threshold of drop_out Program GPA: Lower than %s", 
-                app_config['thresholds']['drop_out'])
+    app.run(port=app_config['server']['port'], host="0.0.0.0")
@@ -0,0 +1,48 @@
+import fcntl
+import logging
+from contextlib import asynccontextmanager
+from threading import Thread
+
+logger = logging.getLogger('basicLogger')
+
+# Open lock files of this process, kept referenced so the locks are held
+# until the process exits
+LOCKS = []
+
+
+def run_as_leader(lock_file, start):
+    """
+    Calls start in only one of the worker processes serving an app. Every
+    worker waits in a background thread for an exclusive lock on lock_file,
+    and the worker that gets it calls start. The OS releases the lock when
+    that worker exits, so a waiting worker takes over background work such
+    as Kafka consumers and schedulers if the leader dies.
+
+    args:
+        string lock_file: the lock file shared by the worker processes
+        function start: starts the background work, and returns
+    """
+    def wait_for_lock():
+        lock = open(lock_file, 'a')
+        fcntl.flock(lock, fcntl.LOCK_EX)
+        LOCKS.append(lock)
+        logger.info("Acquired %s, starting background tasks", lock_file)
+        start()
+
+    Thread(target=wait_for_lock, daemon=True).start()
+
+
+def leader_lifespan(lock_file, start):
+    """
+    Builds a lifespan for a connexion app that runs start in one worker
+    process once the server starts, see run_as_leader
+
+    returns:
+        function: the lifespan to pass to connexion.FlaskApp
+    """
+    @asynccontextmanager
+    async def lifespan(app):
+        run_as_leader(lock_file, start)
+        yield
+
+    return lifespan
@@ -0,0 +1,292 @@
+import logging
+import math
+import os
+import threading
+from collections import deque
+from datetime import datetime
+
+import numpy as np
+import yaml
+
+logger = logging.getLogger('basicLogger')
+
+
+class Rule:
+    """
+    A declarative anomaly rule evaluated over a micro-batch of events of one
+    event type. Subclasses vectorize their check over the batch and return a
+    mask of the events that are anomalies. Events the rule cannot check,
+    such as with a missing or non-numeric field, are skipped one at a time
+    before the batch is vectorized, so they do not fail the whole batch.
+    """
+
+    # The payload fields every anomaly is built from
+    ANOMALY_FIELDS = ("student_id", "trace_id")
+
+    def __init__(self, definition):
+        self.definition = definition
+        self.name = definition['name']
+        self.event_type = definition['event_type']
+        self.anomaly_type = definition['anomaly_type']
+        self.description = definition['description']
+        self.state = {}
+
+    def evaluate(self, events):
+        """
+        Checks a batch of events against the rule
+
+        args:
+            list events: the decoded messages of the rule's event type, oldest first
+
+        returns:
+            list: an anomaly for each event that breaks the rule
+        """
+        events = [event for event in events if self.checkable(event)]
+        if not events:
+            return []
+
+        mask, values = self.check(events)
+        anomalies = []
+        for i in np.flatnonzero(mask):
+            payload = events[i]['payload']
+            anomalies.append({
+                "event_id": payload['student_id'],
+                "trace_id": payload['trace_id'],
+                "event_type": self.event_type,
+                "anomaly_type": self.anomaly_type,
+                "description": self.description.format(value=values[i], **self.definition),
+                "timestamp": datetime.strftime(datetime.now(), "%Y-%m-%d %H:%M:%S")
+            })
+        return anomalies
+
+    def checkable(self, event):
+        """Returns whether the rule can check an event, logging the event if not"""
+        try:
+            self.validate(event)
+            return True
+        except (KeyError, ValueError, TypeError) as e:
+            logger.error("Rule %s skipping event it cannot check %s: %s", self.name, event, e)
+            return False
+
+    def validate(self, event):
+        """
+        Reads the fields of an event the rule needs
+
+        Raises:
+            KeyError: if a field is missing
+            ValueError: if the rule's field is not a number
+            TypeError: if the rule's field is not a number
+        """
+        payload = event['payload']
+        for field in self.ANOMALY_FIELDS + (self.definition['field'],):
+            if field not in payload:
+                raise KeyError(field)
+        float(payload[self.definition['field']])
+
+    def check(self, events):
+        """
+        returns:
+            ndarray: a boolean mask of the events that break the rule
+            list: the value of each event shown in the description
+        """
+        raise NotImplementedError
+
+    def field_values(self, events):
+        """Returns the rule's field of each event as a float array, and as sent"""
+        raw = [event['payload'][self.definition['field']] for event in events]
+        return np.array(raw, dtype=float), raw
+
+
+class ThresholdRule(Rule):
+    """Flags events whose field is above or below a threshold"""
+
+    def check(self, events):
+        values, raw = self.field_values(events)
+        mask = np.zeros(len(values), dtype=bool)
+        if 'above' in self.definition:
+            mask |= values > self.definition['above']
+        if 'below' in self.definition:
+            mask |= values < self.definition['below']
+        return mask, raw
+
+
+class RangeRule(Rule):
+    """Flags events whose field is outside of [min, max]"""
+
+    def check(self, events):
+        values, raw = self.field_values(events)
+        mask = (values < self.definition['min']) | (values > self.definition['max'])
+        return mask, raw
+
+
+class ZScoreRule(Rule):
+    """
+    Flags events whose field is more than threshold standard deviations from
+    the mean of the last window events of the same group (such as program).
+    Groups with fewer than min_samples events are not checked yet.
+    """
+
+    def validate(self, event):
+        super().validate(event)
+        # A value that is not finite would be kept in the window and spoil
+        # the mean of its group
+        if not math.isfinite(float(event['payload'][self.definition['field']])):
+            raise ValueError(f"{self.definition['field']} is not finite")
+        if self.definition['group_by'] not in event['payload']:
+            raise KeyError(self.definition['group_by'])
+
+    def check(self, events):
+        values, _ = self.field_values(events)
+        groups = np.array([str(event['payload'][self.definition['group_by']]) for event in events])
+        window = self.definition['window']
+        mask = np.zeros(len(values), dtype=bool)
+        scores = np.zeros(len(values))
+
+        for group in np.unique(groups):
+            in_group = groups == group
+            history = self.state.setdefault(group, deque(maxlen=window))
+
+            if len(history) >= self.definition['min_samples']:
+                past = np.fromiter(history, dtype=float)
+                std = past.std()
+                if std > 0:
+                    scores[in_group] = np.abs(values[in_group] - past.mean()) / std
+                    mask[in_group] = scores[in_group] > self.definition['threshold']
+
+            history.extend(values[in_group])
+
+        return mask, np.round(scores, 2)
+
+
+class DuplicateRule(Rule):
+    """
+    Flags events whose field (such as student_id) was already seen in an
+    event received less than window_seconds earlier
+    """
+
+    def validate(self, event):
+        payload = event['payload']
+        for field in self.ANOMALY_FIELDS + (self.definition['field'],):
+            if field not in payload:
+                raise KeyError(field)
+        datetime.strptime(event['datetime'], "%Y-%m-%dT%H:%M:%S")
+
+    def check(self, events):
+        keys = np.array([str(event['payload'][self.definition['field']]) for event in events])
+        times = np.array([datetime.strptime(event['datetime'], "%Y-%m-%dT%H:%M:%S").timestamp()
+                          for event in events])
+
+        # Sort by key then time, so each event follows the previous event
+        # with the same key, or comes first if the key is new in the batch
+        order = np.lexsort((times, keys))
+        sorted_keys = keys[order]
+        sorted_times = times[order]
+        previous = np.empty(len(order))
+        previous[1:] = sorted_times[:-1]
+        first = np.ones(len(order), dtype=bool)
+        first[1:] = sorted_keys[1:] != sorted_keys[:-1]
+        last_seen = self.state
+        previous[first] = [last_seen.get(key, -np.inf) for key in sorted_keys[first]]
+
+        mask = np.empty(len(order), dtype=bool)
+        mask[order] = sorted_times - previous < self.definition['window_seconds']
+
+        for key, seen in zip(keys, times):
+            last_seen[key] = max(seen, last_seen.get(key, -np.inf))
+        cutoff = times.max() - self.definition['window_seconds']
+        for key in [key for key, seen in last_seen.items() if seen < cutoff]:
+            del last_seen[key]
+
+        return mask, keys
+
+
+RULE_TYPES = {
+    "threshold": ThresholdRule,
+    "range": RangeRule,
+    "zscore": ZScoreRule,
+    "duplicate": DuplicateRule
+}
+
+
+class RuleEngine:
+    """
+    Evaluates the enabled rules of a rules file over micro-batches of events.
+    The file is checked for changes at most every reload_interval seconds
+    and reloaded in place, keeping the rolling state of rules whose
+    definition did not change, so rules can be edited without restarting
+    the consumer. Consumer workers evaluate their batches one at a time,
+    since rules such as zscore keep state across students and partitions.
+    """
+
+    def __init__(self, filename, reload_interval):
+        self.filename = filename
+        self.reload_interval = reload_interval
+        self.lock = threading.Lock()
+        self.rules = []
+        self.mtime = None
+        self.next_check = 0
+        self.reload()
+
+    def reload(self):
+        """
+        Loads the rules file if it changed since it was last loaded. A file
+        that fails to load is logged and the current rules are kept.
+        """
+        try:
+            mtime = os.path.getmtime(self.filename)
+        except OSError as e:
+            logger.error("Error reading rules file %s: %s", self.filename, e)
+            return
+
+        with self.lock:
+            if mtime == self.mtime:
+                return
+
+            try:
+                with open(self.filename, 'r') as f:
+                    definitions = yaml.safe_load(f.read())['rules']
+                rules = [RULE_TYPES[definition['type']](definition)
+                         for definition in definitions if definition.get('enabled', True)]
+            except Exception as e:
+                logger.error("Error loading rules from %s: %s", self.filename, e)
+                self.mtime = mtime
+                return
+
+            current = { rule.name: rule for rule in self.rules }
+            for rule in rules:
+                if rule.name in current and current[rule.name].definition == rule.definition:
+                    rule.state = current[rule.name].state
+
+            self.rules = rules
+            self.mtime = mtime
+            logger.info("Loaded %d rules from %s", len(rules), self.filename)
+
+    def reload_if_due(self, now):
+        with self.lock:
+            if now < self.next_check:
+                return
+            self.next_check = now + self.reload_interval
+        self.reload()
+
+    def evaluate(self, events):
+        """
+        Checks a batch of events against every rule
+
+        args:
+            list events: the decoded messages of the batch, oldest first
+
+        returns:
+            list: the anomalies found in the batch
+        """
+        by_type = {}
+        for event in events:
+            by_type.setdefault(event['type'], []).append(event)
+
+        anomalies = []
+        with self.lock:
+            for rule in self.rules:
+                try:
+                    anomalies.extend(rule.evaluate(by_type.get(rule.event_type, [])))
+                except Exception as e:
+                    logger.error("Error evaluating rule %s: %s", rule.name, e)
+        return anomalies
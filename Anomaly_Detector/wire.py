@@ -0,0 +1,188 @@
+import json
+import struct
+
+# First byte of a binary message. A legacy JSON message always starts with
+# '{', so consumers tell the two formats apart without a separate header.
+MAGIC = 0xE5
+MAGIC_BYTE = bytes((MAGIC,))
+VERSION = 1
+
+# The type of an event is sent as its index in this tuple, so new types are
+# only ever appended
+EVENT_TYPES = ("enroll", "drop_out")
+EVENT_TYPE_CODES = { event_type: code for code, event_type in enumerate(EVENT_TYPES) }
+
+# magic, version, event type, student_id, trace_id, datetime as year, month,
+# day, hour, minute, second, then the length of the program name
+HEADER = struct.Struct(">BBB16s16sHBBBBBH")
+
+# The fields of each event type after the program name. GPAs are doubles so
+# they decode to the exact value sent, and MM-DD-YYYY dates are year, month
+# and day.
+ENROLL = struct.Struct(">dHBBHBB")
+DROP_OUT = struct.Struct(">dHBB")
+
+ENROLL_FIELDS = { "student_id", "program", "highschool_gpa", "student_acceptance_date",
+                  "program_starting_date", "trace_id" }
+DROP_OUT_FIELDS = { "student_id", "program", "program_gpa", "student_dropout_date", "trace_id" }
+
+
+def format_uuid(value):
+    hex_value = value.hex()
+    return f"{hex_value[:8]}-{hex_value[8:12]}-{hex_value[12:16]}-{hex_value[16:20]}-{hex_value[20:]}"
+
+
+def encode_uuid(value):
+    uuid_bytes = bytes.fromhex(value.replace("-", ""))
+    if len(uuid_bytes) != 16 or format_uuid(uuid_bytes) != value:
+        raise ValueError(f"{value} is not a lowercase hyphenated UUID")
+    return uuid_bytes
+
+
+def format_date(year, month, day):
+    return "%02d-%02d-%04d" % (month, day, year)
+
+
+def encode_date(value):
+    month, day, year = (int(part) for part in value.split("-"))
+    if format_date(year, month, day) != value:
+        raise ValueError(f"{value} is not an MM-DD-YYYY date")
+    return year, month, day
+
+
+def format_datetime(year, month, day, hour, minute, second):
+    return "%04d-%02d-%02dT%02d:%02d:%02d" % (year, month, day, hour, minute, second)
+
+
+def encode_datetime(value):
+    date_part, time_part = value.split("T")
+    parts = [int(part) for part in date_part.split("-") + time_part.split(":")]
+    if format_datetime(*parts) != value:
+        raise ValueError(f"{value} is not a YYYY-MM-DDTHH:MM:SS datetime")
+    return parts
+
+
+def encode_binary(msg):
+    """
+    Encodes an event with the fixed schema of its type
+
+    Raises:
+        ValueError: if the event does not fit the schema exactly, such as an
+            unknown type, an extra field or a date in another format
+    """
+    event_type = msg['type']
+    payload = msg['payload']
+
+    if event_type == "enroll" and payload.keys() == ENROLL_FIELDS:
+        body = ENROLL.pack(float(payload['highschool_gpa']),
+                           *encode_date(payload['student_acceptance_date']),
+                           *encode_date(payload['program_starting_date']))
+    elif event_type == "drop_out" and payload.keys() == DROP_OUT_FIELDS:
+        body = DROP_OUT.pack(float(payload['program_gpa']),
+                             *encode_date(payload['student_dropout_date']))
+    else:
+        raise ValueError(f"{event_type} event does not match the binary schema")
+
+    program = payload['program'].encode('utf-8')
+    header = HEADER.pack(MAGIC, VERSION, EVENT_TYPE_CODES[event_type],
+                         encode_uuid(payload['student_id']), encode_uuid(payload['trace_id']),
+                         *encode_datetime(msg['datetime']), len(program))
+    return b"".join((header, program, body))
+
+
+def encode(msg, wire_format):
+    """
+    Encodes an event for Kafka
+
+    args:
+        dict msg: the event, with type, datetime and payload
+        string wire_format: "binary" for the compact encoding, or "json"
+
+    returns:
+        bytes: the encoded event. Events that do not fit the binary schema
+        are sent as JSON, which every consumer also reads.
+    """
+    if wire_format == "binary":
+        try:
+            return encode_binary(msg)
+        except (KeyError, ValueError, TypeError, AttributeError, struct.error):
+            pass
+    return json.dumps(msg, separators=(",", ":")).encode('utf-8')
+
+
+def decode_binary(value):
+    (_, version, type_code, student_id, trace_id,
+     year, month, day, hour, minute, second, program_length) = HEADER.unpack_from(value)
+    if version != VERSION:
+        raise ValueError(f"Unsupported wire format version {version}")
+
+    program_end = HEADER.size + program_length
+    program = value[HEADER.size:program_end].decode('utf-8')
+
+    if type_code == 0:
+        gpa, accepted_year, accepted_month, accepted_day, start_year, start_month, start_day = \
+            ENROLL.unpack_from(value, program_end)
+        payload = {
+            "student_id": format_uuid(student_id),
+            "program": program,
+            "highschool_gpa": gpa,
+            "student_acceptance_date": format_date(accepted_year, accepted_month, accepted_day),
+            "program_starting_date": format_date(start_year, start_month, start_day),
+            "trace_id": format_uuid(trace_id)
+        }
+    elif type_code == 1:
+        gpa, dropout_year, dropout_month, dropout_day = DROP_OUT.unpack_from(value, program_end)
+        payload = {
+            "student_id": format_uuid(student_id),
+            "program": program,
+            "program_gpa": gpa,
+            "student_dropout_date": format_date(dropout_year, dropout_month, dropout_day),
+            "trace_id": format_uuid(trace_id)
+        }
+    else:
+        raise ValueError(f"Unknown event type code {type_code}")
+
+    return {
+        "type": EVENT_TYPES[type_code],
+        "datetime": format_datetime(year, month, day, hour, minute, second),
+        "payload": payload
+    }
+
+
+def decode(value):
+    """
+    Decodes a Kafka message value in either the binary or the legacy JSON
+    format
+
+    returns:
+        dict: the event, with type, datetime and payload
+
+    Raises:
+        ValueError: if the message cannot be decoded
+    """
+    if value[:1] != MAGIC_BYTE:
+        return json.loads(value)
+    try:
+        return decode_binary(value)
+    except struct.error as e:
+        raise ValueError(f"Malformed binary message: {e}") from e
+
+
+def event_type(value):
+    """
+    Reads only the type of an event from a Kafka message value, without
+    decoding the rest of a binary message
+
+    Raises:
+        ValueError: if the message cannot be decoded
+        KeyError: if a JSON message has no type
+    """
+    if value[:1] != MAGIC_BYTE:
+        return json.loads(value)['type']
+    if len(value) < HEADER.size:
+        raise ValueError("Malformed binary message: truncated header")
+    if value[1] != VERSION:
+        raise ValueError(f"Unsupported wire format version {value[1]}")
+    if value[2] >= len(EVENT_TYPES):
+        raise ValueError(f"Unknown event type code {value[2]}")
+    return EVENT_TYPES[value[2]]
@@ -1,98 +1,164 @@
 import logging
-import logging.config
 import yaml
-import json
+import math
+import threading
+import time
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor
+from datetime import datetime
 from apscheduler.schedulers.background import BackgroundScheduler
 import connexion
+from connexion.middleware import MiddlewarePosition
 import requests
+from requests.adapters import HTTPAdapter
 from requests.exceptions import Timeout, ConnectionError
+from snapshot import Snapshot, read_json, write_json_atomic
+from metrics import MetricsMiddleware, gauge, histogram
+from log_queue import configure_logging
+from leader import leader_lifespan
 
 with open('/config/app_conf.yml', 'r', encoding='utf-8') as file:
     app_config = yaml.safe_load(file.read())
 
 with open('/logs/log_conf.yml', "r", encoding='utf-8') as f:
     log_config = yaml.safe_load(f.read())
-    logging.config.dictConfig(log_config)
+    configure_logging(log_config)
 
 logger = logging.getLogger('basicLogger')
 
-RECEIVER_URL = app_config['receiver']['url']
-STORAGE_URL = app_config['storage']['url']
-PROCESSING_URL = app_config['processor']['url']
-ANALYZER_URL = app_config['analyzer']['url']
 TIMEOUT = app_config['timeout']['seconds']
 
-def check_services():
-    """ Called periodically """
-    global receiver_status
-    receiver_status = "Unavailable"
-    try:
-        response = requests.get(RECEIVER_URL, timeout=TIMEOUT)
-        if response.status_code == 200:
-            receiver_status = "Healthy"
-            logger.info("Receiver is Healthly")
-        else:
-            logger.info("Receiver returning non-200 response")
-    except (Timeout, ConnectionError):
-        logger.info("Receiver is Not Available")
+def describe_receiver(response):
+    return "Healthy"
 
-    global storage_status
-    storage_status = "Unavailable"
-    try:
-        response = requests.get(STORAGE_URL, timeout=TIMEOUT)
-        if response.status_code == 200:
-            storage_json = response.json()
-            storage_status = f"Storage has {storage_json['num_enrolls']} enrolled students and {storage_json['num_drop_outs']} student drop outs"
-            logger.info("Storage is Healthy")
-        else:
-            logger.info("Storage returning non-200 response")
-    except (Timeout, ConnectionError):
-        logger.info("Storage is Not Available")
-    
-    global processor_status
-    processor_status = "Unavailable"
-    try:
-        response = requests.get(PROCESSING_URL, timeout=TIMEOUT)
-        if response.status_code == 200:
-            processor_json = response.json()
-            processor_status = f"Processor has {processor_json['num_enrolled_students']} enrolled students and {processor_json['num_drop_out_students']} student drop outs"
-            logger.info("Processor is healthy")
-        else:
-            logger.info("Processor returning non-200 response")
-    except (Timeout, ConnectionError):
-        logger.info("Processor is Not Available")
+def describe_storage(response):
+    storage_json = response.json()
+    return f"Storage has {storage_json['num_enrolls']} enrolled students and {storage_json['num_drop_outs']} student drop outs"
+
+def describe_processor(response):
+    processor_json = response.json()
+    return f"Processor has {processor_json['num_enrolled_students']} enrolled students and {processor_json['num_drop_out_students']} student drop outs"
+
+def describe_analyzer(response):
+    analyzer_json = response.json()
+    return f"Analyzer has {analyzer_json['num_enrolls']} enrolled students and {analyzer_json['num_drop_outs']} student drop outs"
+
+# service name in the status file: (display name, url, describe healthy response)
+SERVICES = {
+    "receiver": ("Receiver", app_config['receiver']['url'], describe_receiver),
+    "storage": ("Storage", app_config['storage']['url'], describe_storage),
+    "processing": ("Processor", app_config['processor']['url'], describe_processor),
+    "analyzer": ("Analyzer", app_config['analyzer']['url'], describe_analyzer)
+}
+
+# One pooled session and one worker per service, so the probes of a sweep
+# run concurrently over kept-alive connections and a hung service only
+# delays the sweep by TIMEOUT rather than TIMEOUT per service
+SESSION = requests.Session()
+SESSION.mount("http://", HTTPAdapter(pool_maxsize=len(SERVICES)))
+SESSION.mount("https://", HTTPAdapter(pool_maxsize=len(SERVICES)))
+EXECUTOR = ThreadPoolExecutor(max_workers=len(SERVICES))
 
-    global analyzer_status
-    analyzer_status = "Unavailable"
+JOB_TIME = histogram("scheduler_job_duration_seconds", "Wall time of each run of a scheduled job", ["job"])
+PROBE_TIME = histogram("probe_duration_seconds", "Response time of the health endpoint of each service", ["service"])
+SERVICE_UP = gauge("service_up", "Whether the last probe of each service got a 200 response", ["service"])
+
+# Ring buffer of the latest probe results of each service
+HISTORY_LOCK = threading.Lock()
+HISTORY = { service: deque(maxlen=app_config['history']['size']) for service in SERVICES }
+
+# The latest statuses, served from memory and persisted to the status file
+# only for durability
+STATUS_SNAPSHOT = Snapshot()
+try:
+    STATUS_SNAPSHOT.update(read_json('/data/status.json'))
+except FileNotFoundError:
+    pass
+
+def probe(service):
+    """
+    Requests the health endpoint of a service and times the response
+
+    :param string service: the name of the service in SERVICES
+
+    Returns:
+        dict: the status message and latency of the probe
+    """
+    name, url, describe = SERVICES[service]
+    status = "Unavailable"
+    latency_ms = None
+    start = time.monotonic()
     try:
-        response = requests.get(ANALYZER_URL, timeout=TIMEOUT)
+        response = SESSION.get(url, timeout=TIMEOUT)
+        elapsed = time.monotonic() - start
+        latency_ms = round(elapsed * 1000, 2)
+        PROBE_TIME.observe(elapsed, service=service)
         if response.status_code == 200:
-            analyzer_json = response.json()
-            analyzer_status = f"Analyzer has {analyzer_json['num_enrolls']} enrolled students and {analyzer_json['num_drop_outs']} student drop outs"
-            logger.info("Analyzer is healthy")
+            status = describe(response)
+            logger.info("%s is Healthy", name)
         else:
-            logger.info("Analyzer returning non-200 response")
+            logger.info("%s returning non-200 response", name)
     except (Timeout, ConnectionError):
-        logger.info("Analyzer is Not Available")
-    
-    status_json = {
-        "receiver": receiver_status,
-        "storage": storage_status,
-        "processing": processor_status,
-        "analyzer": analyzer_status
+        logger.info("%s is Not Available", name)
+
+    SERVICE_UP.set(int(status != "Unavailable"), service=service)
+    return {
+        "timestamp": datetime.now().strftime("%Y-%m-%d %H:%M:%S"),
+        "status": status,
+        "latency_ms": latency_ms
     }
 
-    with open('/data/status.json', 'w', encoding='utf-8') as file:
-        json.dump(status_json, file, indent=4)
+def check_services():
+    """ Called periodically """
+    with JOB_TIME.time(job="check_services"):
+        results = dict(zip(SERVICES, EXECUTOR.map(probe, SERVICES)))
+
+    with HISTORY_LOCK:
+        for service, result in results.items():
+            HISTORY[service].append(result)
+
+    status_json = { service: result["status"] for service, result in results.items() }
+
+    write_json_atomic('/data/status.json', status_json, indent=4)
+
+    STATUS_SNAPSHOT.update(status_json)
+
+def percentile(sorted_values, q):
+    """Nearest-rank percentile of a sorted list, or None if it is empty"""
+    if not sorted_values:
+        return None
+    return sorted_values[max(math.ceil(q * len(sorted_values)), 1) - 1]
+
+def get_latency():
+    """Get the latency percentiles of each service over the probe history"""
+    with HISTORY_LOCK:
+        history = { service: list(results) for service, results in HISTORY.items() }
+
+    latency_json = {}
+    for service, results in history.items():
+        latencies = sorted(result["latency_ms"] for result in results if result["latency_ms"] is not None)
+        latency_json[service] = {
+            "samples": len(results),
+            "failures": len(results) - len(latencies),
+            "p50": percentile(latencies, 0.5),
+            "p95": percentile(latencies, 0.95),
+            "p99": percentile(latencies, 0.99)
+        }
+    return latency_json, 200
+
+def get_history(service, limit=None):
+    """Get the latest probe results of a service, newest first"""
+    with HISTORY_LOCK:
+        results = list(HISTORY[service])
+    results.reverse()
+    return results[:limit], 200
 
 def get_checks():
-    """Get checks in status storage file"""
-    try:
-        with open('/data/status.json', 'r', encoding='utf-8') as file:
-            status_json = json.load(file)
-        return status_json, 200
-    except FileNotFoundError:
+    """Get the latest checks, or 304 if the client's If-None-Match is still current"""
+    response = STATUS_SNAPSHOT.respond(connexion.request.headers.get("If-None-Match"))
+    if response is None:
         return { "message": "File does not exist" }, 404
+    return response
     
 def init_scheduler():
     """Start the periodic scheduling"""
@@ -102,9 +168,11 @@ def init_scheduler():
                   seconds=app_config['scheduler']['seconds'])
     sched.start()
 
-app = connexion.FlaskApp(__name__, specification_dir='')
+app = connexion.FlaskApp(__name__, specification_dir='',
+                         lifespan=leader_lifespan(app_config['server']['lock_file'], init_scheduler))
 app.add_api("openapi.yml", base_path="/check", strict_validation=True, validate_responses=True)
+app.add_middleware(MetricsMiddleware, position=MiddlewarePosition.BEFORE_EXCEPTION, path="/check/metrics",
+                   shared_dir=app_config['server']['metrics_dir'])
 
 if __name__ == "__main__":
-    init_scheduler()
-    app.run(port=8130, host="0.0.0.0")
+    app.run(port=app_config['server']['port'], host="0.0.0.0")
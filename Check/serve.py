@@ -0,0 +1,25 @@
+"""
+Production entry point. Serves app:app with the number of uvicorn worker
+processes configured in the server section of app_conf.yml. The app module
+is only imported by the workers, and background tasks are started in one
+worker of the group (see leader.py). The metrics the workers share are
+cleared on start up, as they are of the previous server's processes.
+"""
+import shutil
+
+import uvicorn
+import yaml
+
+with open('/config/app_conf.yml', 'r', encoding='utf-8') as f:
+    SERVER_CONFIG = yaml.safe_load(f.read())['server']
+
+if __name__ == "__main__":
+    shutil.rmtree(SERVER_CONFIG['metrics_dir'], ignore_errors=True)
+    uvicorn.run("app:app",
+                host="0.0.0.0",
+                port=SERVER_CONFIG['port'],
+                workers=SERVER_CONFIG['workers'],
+                backlog=SERVER_CONFIG['backlog'],
+                timeout_keep_alive=SERVER_CONFIG['keep_alive_sec'],
+                access_log=False,
+                log_config=None)
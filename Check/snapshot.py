@@ -0,0 +1,125 @@
+import hashlib
+import json
+import logging
+import os
+import shutil
+import tempfile
+
+from connexion import NoContent
+
+logger = logging.getLogger('basicLogger')
+
+
+def generation_path(filename, generation):
+    """Names an older generation of a file, such as data.json.1 for the previous one"""
+    return f"{filename}.{generation}"
+
+
+def write_json_atomic(filename, data, generations=0, **dump_args):
+    """
+    Writes a JSON file so that readers and a crash only ever see the old or
+    the new version, never a partial one. The data is written to a temp
+    file in the same directory, fsynced and renamed over the file. The last
+    few replaced versions are kept as filename.1, filename.2 and so on.
+
+    args:
+        string filename: the file to write
+        object data: the data to write as JSON
+        int generations: how many previous versions to keep
+        dump_args: extra arguments for json.dump, such as indent
+    """
+    directory = os.path.dirname(os.path.abspath(filename))
+    fd, temp_path = tempfile.mkstemp(dir=directory, prefix=os.path.basename(filename) + ".", suffix=".tmp")
+    try:
+        with os.fdopen(fd, 'w', encoding='utf-8') as file:
+            json.dump(data, file, **dump_args)
+            file.flush()
+            os.fsync(file.fileno())
+
+        if generations > 0 and os.path.isfile(filename):
+            for generation in range(generations - 1, 0, -1):
+                if os.path.isfile(generation_path(filename, generation)):
+                    os.replace(generation_path(filename, generation),
+                               generation_path(filename, generation + 1))
+            # Keep the current version in place while it is backed up, so
+            # readers always find a complete file
+            try:
+                os.link(filename, generation_path(filename, 1))
+            except OSError:
+                shutil.copyfile(filename, generation_path(filename, 1))
+
+        os.replace(temp_path, filename)
+    except BaseException:
+        if os.path.exists(temp_path):
+            os.remove(temp_path)
+        raise
+
+    # Persist the rename itself
+    try:
+        dir_fd = os.open(directory, os.O_RDONLY)
+        try:
+            os.fsync(dir_fd)
+        finally:
+            os.close(dir_fd)
+    except OSError:
+        pass
+
+
+def read_json(filename, generations=0):
+    """
+    Reads a JSON file written by write_json_atomic, falling back to the
+    newest older generation that is intact if the file is missing or corrupt
+
+    Raises:
+        FileNotFoundError: If no generation of the file can be read
+    """
+    for path in [filename] + [generation_path(filename, g) for g in range(1, generations + 1)]:
+        try:
+            with open(path, 'r', encoding='utf-8') as file:
+                return json.load(file)
+        except FileNotFoundError:
+            continue
+        except ValueError as e:
+            logger.error("Skipping corrupt snapshot %s: %s", path, e)
+    raise FileNotFoundError(filename)
+
+
+class Snapshot:
+    """
+    The latest version of a JSON document served by a GET endpoint, kept in
+    memory with an ETag of its contents so polling clients can revalidate
+    with If-None-Match and get a 304 instead of the document. The document
+    and its ETag are replaced together as one tuple, so readers never see a
+    half updated snapshot and need no lock.
+    """
+
+    def __init__(self):
+        self.current = None
+
+    def update(self, data):
+        """Replaces the document with a new version"""
+        body = json.dumps(data, sort_keys=True).encode('utf-8')
+        self.current = (data, '"%s"' % hashlib.sha256(body).hexdigest()[:32])
+
+    def respond(self, if_none_match):
+        """
+        Builds the response to a GET of the document
+
+        args:
+            string if_none_match: the If-None-Match header of the request, if any
+
+        returns:
+            tuple: the document, 200 and its ETag header, or 304 if the client
+            already has this version, or None if there is no document yet
+        """
+        current = self.current
+        if current is None:
+            return None
+
+        data, etag = current
+        headers = { "ETag": etag, "Cache-Control": "no-cache" }
+        if if_none_match:
+            tags = [tag.strip().removeprefix("W/") for tag in if_none_match.split(",")]
+            if etag in tags or "*" in tags:
+                return NoContent, 304, headers
+        return data, 200, headers
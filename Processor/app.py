@@ -1,15 +1,23 @@
 import yaml
 import logging
-import logging.config
 from apscheduler.schedulers.background import BackgroundScheduler
 import os
 import json
+import time
+from concurrent.futures import ThreadPoolExecutor
 from datetime import datetime, timedelta
-from statistics import mean
 import requests
+from requests.adapters import HTTPAdapter
 import connexion
 from connexion import NoContent
+from connexion.middleware import MiddlewarePosition
 from flask_cors import CORS
+from running_stats import RunningStats, StatsAccumulator, semester_of
+from snapshot import Snapshot, read_json, write_json_atomic
+from metrics import MetricsMiddleware, counter, histogram
+from log_queue import configure_logging
+from leader import leader_lifespan
+from sse import EventStreamMiddleware, StateStream
 
 
 APP_CONF_FILE = ""
@@ -29,7 +37,7 @@ with open(APP_CONF_FILE, "r", encoding='utf-8') as file:
 
 with open(LOG_CONF_FILE, "r", encoding='utf-8') as file:
     LOG_CONFIG = yaml.safe_load(file.read())
-    logging.config.dictConfig(LOG_CONFIG)
+    configure_logging(LOG_CONFIG)
 
 logger = logging.getLogger('basicLogger')
 
@@ -47,15 +55,13 @@ if not os.path.isfile(APP_CONFIG['datastore']['filename']):
         "last_updated": datetime.strftime(datetime.now() - timedelta(seconds=5),
                                           '%Y-%m-%dT:%H:%M:%S')
     }
-    with open(APP_CONFIG['datastore']['filename'], "w", encoding='utf-8') as file:
-        json.dump(base_stats, file, indent=4)
+    write_json_atomic(APP_CONFIG['datastore']['filename'], base_stats, indent=4)
 
 def get_json_data():
     """Retrieve data from the json datastore"""
-    if os.path.isfile(APP_CONFIG['datastore']['filename']):
-        with open(APP_CONFIG['datastore']['filename'], 'r', encoding='utf-8') as file:
-            return json.load(file)
-    else:
+    try:
+        return read_json(APP_CONFIG['datastore']['filename'], APP_CONFIG['datastore']['generations'])
+    except FileNotFoundError:
         return {
             "num_enrolled_students": 0,
                "min_enrolled_student_gpa": 4.0,
@@ -67,90 +73,376 @@ def get_json_data():
                                               '%Y-%m-%dT:%H:%M:%S')
         }
 
+# The latest stats, served from memory and persisted to the json datastore
+# for durability and for the worker processes that do not run the scheduler
+STATS_SNAPSHOT = Snapshot()
+STATS_SNAPSHOT.update(get_json_data())
+STATS_FILE = { "mtime": None }
 
-def populate_stats():
-    """Periodically update stats"""
-    logger.info("Periodic processing has started")
+# The stats of each event type broken down by program and by semester,
+# served from memory and reloaded from the accumulator file like the stats
+BREAKDOWN_SNAPSHOT = Snapshot()
+ACCUMULATOR_FILE = { "mtime": None }
+
+
+def refresh_stats_snapshot():
+    """
+    Reloads the stats snapshot when the json datastore was saved since it
+    was last loaded, which costs a stat per request. Only one worker process
+    runs the scheduler, so the others pick up its stats from the datastore.
+    """
+    try:
+        mtime = os.stat(APP_CONFIG['datastore']['filename']).st_mtime_ns
+    except FileNotFoundError:
+        return
+
+    if mtime != STATS_FILE["mtime"]:
+        STATS_FILE["mtime"] = mtime
+        STATS_SNAPSHOT.update(get_json_data())
+
+
+def current_stats():
+    """Returns the latest stats, as served by get_stats"""
+    refresh_stats_snapshot()
+    return STATS_SNAPSHOT.current[0]
+
+
+# Pushes the stats that changed to dashboards subscribed to /stats/stream
+STATS_STREAM = StateStream("stats", current_stats, APP_CONFIG['stream']['interval_sec'],
+                           APP_CONFIG['stream']['queue_size'])
+
+
+# event type: (Storage endpoint, GPA field, date field deciding the semester)
+EVENT_SOURCES = {
+    "enroll": ("enroll", "highschool_gpa", "program_starting_date"),
+    "drop_out": ("drop-out", "program_gpa", "student_dropout_date")
+}
+
+# Storage is fetched over one pooled session, with a worker per event type
+# so both event types are fetched concurrently
+SESSION = requests.Session()
+SESSION.mount("http://", HTTPAdapter(pool_maxsize=len(EVENT_SOURCES)))
+SESSION.mount("https://", HTTPAdapter(pool_maxsize=len(EVENT_SOURCES)))
+EXECUTOR = ThreadPoolExecutor(max_workers=len(EVENT_SOURCES))
+# (connect, read) timeout of the requests to Storage, so a hung Storage fails
+# the scheduled run instead of blocking it and every later run
+TIMEOUT = (APP_CONFIG['eventstore']['connect_timeout_sec'], APP_CONFIG['eventstore']['read_timeout_sec'])
+
+JOB_TIME = histogram("scheduler_job_duration_seconds", "Wall time of each run of a scheduled job", ["job"])
+FETCH_TIME = histogram("storage_fetch_duration_seconds", "Time spent fetching from Storage", ["endpoint"])
+EVENTS_MERGED = counter("events_merged_total", "Events merged into the running stats", ["event_type"])
+
+
+def load_accumulators():
+    """
+    Loads the running GPA stats of each event type along with the time they
+    were last updated and the id of the last event of each type merged into
+    them. When no stats have been persisted yet they are seeded from the json
+    datastore, so existing counts and averages carry over.
+
+    returns:
+        dict: the enroll and drop_out StatsAccumulators, last_updated and last_ids
+    """
+    quantiles = APP_CONFIG['datastore']['quantiles']
+
+    try:
+        data = read_json(APP_CONFIG['datastore']['accumulator_file'], APP_CONFIG['datastore']['generations'])
+    except FileNotFoundError:
+        data = None
+
+    if data is not None:
+        return {
+            "enroll": StatsAccumulator.from_dict(quantiles, data["enroll"]),
+            "drop_out": StatsAccumulator.from_dict(quantiles, data["drop_out"]),
+            "last_updated": data["last_updated"],
+            "last_ids": data.get("last_ids", { "enroll": None, "drop_out": None })
+        }
 
     json_data = get_json_data()
+    enroll = StatsAccumulator(quantiles)
+    drop_out = StatsAccumulator(quantiles)
 
-    logger.debug(json_data)
+    if json_data["num_enrolled_students"] > 0:
+        enroll.overall = RunningStats(json_data["num_enrolled_students"],
+                                      json_data["avg_enrolled_student_gpa"] * json_data["num_enrolled_students"],
+                                      json_data["avg_enrolled_student_gpa"] ** 2 * json_data["num_enrolled_students"],
+                                      json_data["min_enrolled_student_gpa"],
+                                      json_data["min_enrolled_student_gpa"])
+    if json_data["num_drop_out_students"] > 0:
+        drop_out.overall = RunningStats(json_data["num_drop_out_students"],
+                                        json_data["avg_drop_out_student_gpa"] * json_data["num_drop_out_students"],
+                                        json_data["avg_drop_out_student_gpa"] ** 2 * json_data["num_drop_out_students"],
+                                        json_data["max_drop_out_student_gpa"],
+                                        json_data["max_drop_out_student_gpa"])
+
+    return { "enroll": enroll, "drop_out": drop_out, "last_updated": json_data["last_updated"],
+             "last_ids": { "enroll": None, "drop_out": None } }
 
+
+def breakdowns(accumulators):
+    """Breaks down the stats of each event type by program and by semester"""
+    return { event_type: { by: accumulators[event_type].breakdown(by) for by in ("program", "semester") }
+             for event_type in ("enroll", "drop_out") }
+
+
+def refresh_breakdown_snapshot():
+    """
+    Reloads the breakdown snapshot when the accumulator file was saved since
+    it was last loaded, which costs a stat per request
+    """
     try:
-        start_timestamp = json_data['last_updated']
-        current_date = datetime.strftime(datetime.now(), '%Y-%m-%dT:%H:%M:%S')
-    except:
-        logger.debug("OH MY GOSH")
-    logger.debug("\n DATE\n")
-    logger.debug(current_date)
+        mtime = os.stat(APP_CONFIG['datastore']['accumulator_file']).st_mtime_ns
+    except FileNotFoundError:
+        mtime = None
+
+    if BREAKDOWN_SNAPSHOT.current is None or mtime != ACCUMULATOR_FILE["mtime"]:
+        ACCUMULATOR_FILE["mtime"] = mtime
+        BREAKDOWN_SNAPSHOT.update(breakdowns(load_accumulators()))
+
+
+def save_accumulators(accumulators):
+    """
+    Persists the running GPA stats, then the stats snapshot derived from
+    them to the json datastore, and serves the new stats and breakdowns
+
+    args:
+        dict accumulators: the enroll and drop_out StatsAccumulators, last_updated and last_ids
+
+    returns:
+        None
+    """
+    enroll = accumulators["enroll"].overall
+    drop_out = accumulators["drop_out"].overall
+
+    write_json_atomic(APP_CONFIG['datastore']['accumulator_file'], {
+        "enroll": accumulators["enroll"].to_dict(),
+        "drop_out": accumulators["drop_out"].to_dict(),
+        "last_updated": accumulators["last_updated"],
+        "last_ids": accumulators["last_ids"]
+    }, APP_CONFIG['datastore']['generations'])
+
+    json_data = {
+        "num_enrolled_students": enroll.count,
+        "min_enrolled_student_gpa": enroll.minimum if enroll.minimum is not None else 0,
+        "avg_enrolled_student_gpa": enroll.mean,
+        "num_drop_out_students": drop_out.count,
+        "max_drop_out_student_gpa": drop_out.maximum if drop_out.maximum is not None else 0,
+        "avg_drop_out_student_gpa": drop_out.mean,
+        "last_updated": accumulators["last_updated"]
+    }
+
+    logger.debug(json_data)
+
+    write_json_atomic(APP_CONFIG['datastore']['filename'], json_data,
+                      APP_CONFIG['datastore']['generations'], indent=4)
+
+    STATS_SNAPSHOT.update(json_data)
+    ACCUMULATOR_FILE["mtime"] = os.stat(APP_CONFIG['datastore']['accumulator_file']).st_mtime_ns
+    BREAKDOWN_SNAPSHOT.update(breakdowns(accumulators))
+
+
+def populate_stats():
+    """Periodically update stats"""
+    logger.info("Periodic processing has started")
+
+    accumulators = load_accumulators()
+
+    start_timestamp = accumulators['last_updated']
+    current_date = datetime.strftime(datetime.now(), '%Y-%m-%dT:%H:%M:%S')
+    logger.debug("Processing events from %s to %s, after event ids %s",
+                 start_timestamp, current_date, accumulators['last_ids'])
 
     header = {"Content-Type": "application/json"}
     params = {"start_timestamp": start_timestamp, "end_timestamp": current_date}
-    enroll_response = ""
-    drop_out_response = {}
+
+    start = time.monotonic()
     try:
-        enroll_response = requests.get(f"{APP_CONFIG['eventstore']['url']}/enroll",
-                                       params=params, headers=header)
-        drop_out_response = requests.get(f"{APP_CONFIG['eventstore']['url']}/drop-out",
-                                         params=params, headers=header)
-        logger.debug("ENROLL RESPONSE\n---------------\n")
-        logger.debug(enroll_response.json())
-        logger.info("Received %d enroll events", len(enroll_response.json()))
-        logger.info("Received %d drop-out events", len(drop_out_response.json()))
-
-        if enroll_response.status_code != 200:
-            logger.error("Did not receive a 200 response code from enroll endpoint")
-            return
-        if drop_out_response.status_code != 200:
-            logger.error("Did not receive a 200 response code from drop-out endpoint")
+        if APP_CONFIG['eventstore']['mode'] == "aggregate":
+            updated = merge_aggregates(accumulators, params, header)
+        else:
+            updated = merge_events(accumulators, params, header)
+
+        if not updated:
             return
 
-        enroll_gpa = [event["highschool_gpa"] for event in enroll_response.json()]
-        drop_out_gpa = [event["program_gpa"] for event in drop_out_response.json()]
+        accumulators["last_updated"] = current_date
+        save_accumulators(accumulators)
+    except Exception as e:
+        logger.exception(e)
+    finally:
+        elapsed = time.monotonic() - start
+        JOB_TIME.observe(elapsed, job="populate_stats")
+        logger.info("Periodic processing took %.3f seconds", elapsed)
+
 
-        enroll_gpa += [json_data["min_enrolled_student_gpa"]]
-        drop_out_gpa += [json_data["max_drop_out_student_gpa"]]
+def event_params(accumulators, event_type, params):
+    """
+    Builds the query for the new events of a type: the events after the
+    last merged id once it is known, or the period's timeframe until then
+    """
+    last_id = accumulators["last_ids"][event_type]
+    return params if last_id is None else { "after_id": last_id }
 
-        json_data["num_enrolled_students"] += len(enroll_response.json())
-        json_data["min_enrolled_student_gpa"] = min(enroll_gpa)
-        json_data["avg_enrolled_student_gpa"] = mean(enroll_gpa)
-        json_data["num_drop_out_students"] += len(drop_out_response.json())
-        json_data["max_drop_out_student_gpa"] = max(drop_out_gpa)
-        json_data["avg_drop_out_student_gpa"] = mean(drop_out_gpa)
-        json_data["last_updated"] = current_date
 
-        logger.debug(json_data)
+def fetch_events(accumulator, event_type, params, header):
+    """
+    Streams the new events of a type from Storage as NDJSON and adds each
+    event's GPA to the running stats as it is decoded, so each event is
+    parsed once and the events are never all held in memory
 
-        with open(APP_CONFIG['datastore']['filename'], 'w', encoding='utf-8') as file:
-            json.dump(json_data, file, indent=4)
-    except Exception as e:
-        logger.exception(e)
+    args:
+        object accumulator: the StatsAccumulator of the event type
+        string event_type: "enroll" or "drop_out"
+        dict params: the query for the new events
+        dict header: the request headers
+
+    returns:
+        tuple: the number of events merged and the id of the last one, or None
+        if Storage did not return the events
+    """
+    endpoint, gpa_field, date_field = EVENT_SOURCES[event_type]
+
+    with FETCH_TIME.time(endpoint=endpoint), \
+            SESSION.get(f"{APP_CONFIG['eventstore']['url']}/{endpoint}", params=params,
+                        headers={**header, "Accept": "application/x-ndjson"}, stream=True,
+                        timeout=TIMEOUT) as response:
+        if response.status_code != 200:
+            logger.error("Did not receive a 200 response code from %s endpoint", endpoint)
+            return None
+
+        count = 0
+        last_id = None
+        for line in response.iter_lines():
+            if not line:
+                continue
+            event = json.loads(line)
+            accumulator.add(event[gpa_field], event["program"], semester_of(event[date_field]))
+            count += 1
+            last_id = event["id"] if last_id is None else max(last_id, event["id"])
+
+    EVENTS_MERGED.inc(count, event_type=event_type)
+    logger.info("Received %d %s events", count, event_type)
+    return count, last_id
+
+
+def merge_events(accumulators, params, header):
+    """
+    Fetches the enroll and drop-out events Storage stored since the last
+    merged event ids concurrently and adds each event's GPA to the running
+    stats
+
+    args:
+        dict accumulators: the enroll and drop_out StatsAccumulators and last_ids
+        dict params: the start_timestamp and end_timestamp of the period
+        dict header: the request headers
+
+    returns:
+        bool: whether the period's events were merged
+    """
+    futures = {
+        event_type: EXECUTOR.submit(fetch_events, accumulators[event_type], event_type,
+                                    event_params(accumulators, event_type, params), header)
+        for event_type in EVENT_SOURCES
+    }
+    results = { event_type: future.result() for event_type, future in futures.items() }
+
+    if None in results.values():
+        return False
+
+    for event_type, (count, last_id) in results.items():
+        if last_id is not None:
+            accumulators["last_ids"][event_type] = last_id
+
+    return True
+
+
+def merge_aggregates(accumulators, params, header):
+    """
+    Fetches the GPA aggregates Storage computes for the events stored since
+    the last merged event ids and merges them into the running stats, so
+    only the aggregates are transferred instead of every event row.
+    Quantiles cannot be kept in this mode.
+
+    args:
+        dict accumulators: the enroll and drop_out StatsAccumulators and last_ids
+        dict params: the start_timestamp and end_timestamp of the period
+        dict header: the request headers
+
+    returns:
+        bool: whether the period's aggregates were merged
+    """
+    params = {**params, "group_by": ["program", "semester"]}
+    for event_type, last_id in accumulators["last_ids"].items():
+        if last_id is not None:
+            params[f"{event_type}_after_id"] = last_id
+
+    with FETCH_TIME.time(endpoint="aggregates"):
+        response = SESSION.get(f"{APP_CONFIG['eventstore']['url']}/aggregates",
+                               params=params, headers=header, timeout=TIMEOUT)
+
+    if response.status_code != 200:
+        logger.error("Did not receive a 200 response code from aggregates endpoint")
+        return False
+
+    aggregates = response.json()
+    logger.info("Received aggregates of %d enroll events", aggregates["enroll"]["count"])
+    logger.info("Received aggregates of %d drop-out events", aggregates["drop_out"]["count"])
+
+    EVENTS_MERGED.inc(aggregates["enroll"]["count"], event_type="enroll")
+    EVENTS_MERGED.inc(aggregates["drop_out"]["count"], event_type="drop_out")
+    accumulators["enroll"].merge_aggregate(aggregates["enroll"])
+    accumulators["drop_out"].merge_aggregate(aggregates["drop_out"])
+    accumulators["last_ids"] = {
+        "enroll": aggregates["enroll"]["last_id"],
+        "drop_out": aggregates["drop_out"]["last_id"]
+    }
+
+    return True
 
 def get_stats():
     """
-    Receives a GET request for the data stored in the json datastore.
+    Receives a GET request for the latest stats snapshot, which is served
+    from memory. Clients that send the snapshot's ETag back in If-None-Match
+    get a 304 until the stats change.
 
     returns:
-        object: the events in the json data store
-        int: a 200 status code saying the events were retrieved
+        object: the latest stats
+        int: a 200 status code saying the stats were retrieved, or 304 if unchanged
+        dict: the ETag of the stats
 
     """
     logger.info("Request for statistics has been received")
 
-    statistics = {}
-    try:
-        with open(APP_CONFIG['datastore']['filename'], encoding='utf-8') as f:
-            statistics = json.load(f)
-            logger.info(statistics)
-    except FileNotFoundError:
+    refresh_stats_snapshot()
+    response = STATS_SNAPSHOT.respond(connexion.request.headers.get("If-None-Match"))
+    if response is None:
         logger.error("No statistics found")
         return NoContent, 404
 
-
-    logger.debug("Statistics: %s", statistics)
     logger.info("Request has been completed")
 
-    return statistics, 200
+    return response
+
+
+def get_stats_breakdown(event_type, by):
+    """
+    Receives a GET request for the GPA stats of an event type broken down
+    by program or by semester, which are served from memory.
+
+    args:
+        string event_type: "enroll" or "drop_out"
+        string by: "program" or "semester"
+
+    returns:
+        list: the stats of each program or semester
+        int: a 200 status code saying the stats were retrieved
+
+    """
+    logger.info("Request for %s statistics by %s has been received", event_type, by)
+
+    refresh_breakdown_snapshot()
+
+    return BREAKDOWN_SNAPSHOT.current[0][event_type][by], 200
 
 
 def init_scheduler():
@@ -161,11 +453,17 @@ def init_scheduler():
     sched.start()
 
 
-app = connexion.FlaskApp(__name__, specification_dir='')
+app = connexion.FlaskApp(__name__, specification_dir='',
+                         lifespan=leader_lifespan(APP_CONFIG['server']['lock_file'], init_scheduler))
 app.add_api("openapi.yaml", 
             base_path="/processing", 
             strict_validation=True, 
             validate_responses=True)
+app.add_middleware(EventStreamMiddleware, position=MiddlewarePosition.BEFORE_EXCEPTION,
+                   path="/processing/stats/stream", stream=STATS_STREAM,
+                   keep_alive_sec=APP_CONFIG['stream']['keep_alive_sec'])
+app.add_middleware(MetricsMiddleware, position=MiddlewarePosition.BEFORE_EXCEPTION, path="/processing/metrics",
+                   shared_dir=APP_CONFIG['server']['metrics_dir'])
 
 # Connexion wraps around Flask, and app.app allows you to access the underlying Flask application
 if not "TARGET_ENV" in os.environ or os.environ['TARGET_ENV'] != "test":
@@ -182,5 +480,4 @@ if not "TARGET_ENV" in os.environ or os.environ['TARGET_ENV'] != "test":
 # )
 
 if __name__ == "__main__":
-    init_scheduler()
-    app.run(port=8100, host="0.0.0.0")
+    app.run(port=APP_CONFIG['server']['port'], host="0.0.0.0")
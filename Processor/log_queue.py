@@ -0,0 +1,152 @@
+import atexit
+import fcntl
+import logging
+import logging.config
+import queue
+import os
+import random
+from logging.handlers import QueueHandler, QueueListener
+
+from metrics import counter
+
+LOG_RECORDS_DROPPED = counter("log_records_dropped_total",
+                              "Log records dropped because the logging queue was full", ["logger"])
+
+# Open lock file of the worker slot of this process, kept referenced so the
+# slot is held until the process exits
+SLOT_LOCKS = []
+
+
+class SampleFilter(logging.Filter):
+    """
+    Passes a random sample of the records of a logger, such as one in a
+    hundred of the per-event payload logs, so payloads can be logged on hot
+    paths without logging every event. Configured in log_conf.yml as:
+
+        filters:
+          payload_sample:
+            (): log_queue.SampleFilter
+            rate: 0.01
+    """
+
+    def __init__(self, rate=1.0):
+        super().__init__()
+        self.rate = rate
+
+    def filter(self, record):
+        return self.rate >= 1 or random.random() < self.rate
+
+
+class DroppingQueueHandler(QueueHandler):
+    """
+    Hands records to a QueueListener thread without blocking the thread
+    that logged them. When the bounded queue is full the record is dropped
+    and counted instead of waiting for the handlers to catch up.
+    """
+
+    def __init__(self, log_queue, name):
+        super().__init__(log_queue)
+        self.logger_name = name
+
+    def prepare(self, record):
+        # The queue stays in process, so the record is passed as is and the
+        # message is only formatted on the listener thread
+        return record
+
+    def enqueue(self, record):
+        try:
+            self.queue.put_nowait(record)
+        except queue.Full:
+            LOG_RECORDS_DROPPED.inc(logger=self.logger_name)
+
+
+def worker_filename(filename, slot):
+    """Names the copy of a log file written by a worker, such as app.worker0.log for app.log"""
+    root, ext = os.path.splitext(filename)
+    return f"{root}.worker{slot}{ext}"
+
+
+def claim_worker_slot(filename, max_workers):
+    """
+    Claims the lowest worker slot not held by another process, with an
+    exclusive lock on a lock file per slot. The OS releases the lock when the
+    process exits, so a worker restarted by uvicorn takes over the slot, and
+    its log files, of the worker it replaces.
+
+    args:
+        string filename: the log file the lock files are named after
+        int max_workers: the number of slots
+
+    returns:
+        int: the claimed slot
+    """
+    for slot in range(max_workers):
+        lock = open(worker_filename(filename, slot) + ".lock", 'a')
+        try:
+            fcntl.flock(lock, fcntl.LOCK_EX | fcntl.LOCK_NB)
+        except BlockingIOError:
+            lock.close()
+            continue
+        SLOT_LOCKS.append(lock)
+        return slot
+    raise RuntimeError(f"All {max_workers} log file slots of {filename} are taken")
+
+
+def configure_logging(log_config):
+    """
+    Configures logging from log_conf.yml. With queue enabled, the handlers
+    of each listed logger are moved behind a QueueHandler and run by a
+    QueueListener thread, so console and file I/O happen off the request
+    and consumer threads. The listeners are stopped, flushing the queued
+    records, when the process exits.
+
+    With worker_files enabled, each worker process serving the app writes
+    its own copy of each log file, named after the worker slot it claims,
+    since the rotating file handlers of several processes writing one file
+    would rotate it from under each other and lose records.
+
+    args:
+        dict log_config: the dictConfig of log_conf.yml, with an optional
+            queue section of enabled, max_size and loggers, and an optional
+            worker_files section of enabled and max_workers
+
+    returns:
+        list: the started QueueListeners
+    """
+    log_config = dict(log_config)
+    queue_config = log_config.pop('queue', None)
+    worker_files_config = log_config.pop('worker_files', None)
+
+    if worker_files_config and worker_files_config['enabled']:
+        handlers = { name: dict(handler) for name, handler in log_config.get('handlers', {}).items() }
+        filenames = [handler['filename'] for handler in handlers.values() if 'filename' in handler]
+        if filenames:
+            slot = claim_worker_slot(filenames[0], worker_files_config['max_workers'])
+            for handler in handlers.values():
+                if 'filename' in handler:
+                    handler['filename'] = worker_filename(handler['filename'], slot)
+            log_config['handlers'] = handlers
+
+    logging.config.dictConfig(log_config)
+
+    if not queue_config or not queue_config['enabled']:
+        return []
+
+    listeners = []
+    for name in queue_config['loggers']:
+        logger = logging.getLogger() if name == "root" else logging.getLogger(name)
+        handlers = logger.handlers[:]
+        if not handlers:
+            continue
+
+        log_queue = queue.Queue(maxsize=queue_config['max_size'])
+        for handler in handlers:
+            logger.removeHandler(handler)
+        logger.addHandler(DroppingQueueHandler(log_queue, name))
+
+        listener = QueueListener(log_queue, *handlers, respect_handler_level=True)
+        listener.start()
+        atexit.register(listener.stop)
+        listeners.append(listener)
+
+    return listeners
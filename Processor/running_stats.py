@@ -0,0 +1,197 @@
+import math
+from datetime import datetime
+
+
+def semester_of(date_string):
+    """
+    Names the semester a date falls in, such as "2025 Winter" for January to
+    April, "2025 Summer" for May to August and "2025 Fall" for September to
+    December. Matches the semesters Storage groups its aggregates by.
+
+    args:
+        string date_string: an ISO formatted date, such as "2025-01-06"
+
+    returns:
+        string: the semester of the date
+    """
+    date = datetime.strptime(date_string[:10], "%Y-%m-%d")
+    if date.month <= 4:
+        return f"{date.year} Winter"
+    if date.month <= 8:
+        return f"{date.year} Summer"
+    return f"{date.year} Fall"
+
+
+class RunningStats:
+    """
+    Running count, sum, sum of squares, min and max of a stream of GPAs,
+    which can be merged with the stats of later events without keeping
+    the events themselves. When a histogram is kept, GPAs are counted per
+    hundredth (the precision Storage keeps them with) so quantiles are exact
+    while memory stays bounded by the number of distinct GPAs.
+    """
+
+    def __init__(self, count=0, total=0.0, sum_squares=0.0, minimum=None, maximum=None, histogram=None):
+        self.count = count
+        self.total = total
+        self.sum_squares = sum_squares
+        self.minimum = minimum
+        self.maximum = maximum
+        self.histogram = histogram
+
+    def add(self, value):
+        """Adds a single GPA to the stats"""
+        value = float(value)
+        self.count += 1
+        self.total += value
+        self.sum_squares += value * value
+        self.minimum = value if self.minimum is None else min(self.minimum, value)
+        self.maximum = value if self.maximum is None else max(self.maximum, value)
+
+        if self.histogram is not None:
+            bucket = str(round(value * 100))
+            self.histogram[bucket] = self.histogram.get(bucket, 0) + 1
+
+    def merge(self, other):
+        """
+        Merges the stats of another batch of GPAs into these stats. The
+        histogram is dropped if the other stats do not keep one, since the
+        quantiles could no longer be exact.
+        """
+        if other.count == 0:
+            return
+
+        self.count += other.count
+        self.total += other.total
+        self.sum_squares += other.sum_squares
+        self.minimum = other.minimum if self.minimum is None else min(self.minimum, other.minimum)
+        self.maximum = other.maximum if self.maximum is None else max(self.maximum, other.maximum)
+
+        if self.histogram is not None and other.histogram is not None:
+            for bucket, count in other.histogram.items():
+                self.histogram[bucket] = self.histogram.get(bucket, 0) + count
+        else:
+            self.histogram = None
+
+    @classmethod
+    def from_aggregate(cls, aggregate):
+        """Builds stats from an aggregate returned by Storage's aggregates endpoint"""
+        return cls(aggregate["count"], aggregate["sum"], aggregate["sum_squares"],
+                   aggregate["min"], aggregate["max"])
+
+    @property
+    def mean(self):
+        return self.total / self.count if self.count else 0
+
+    @property
+    def stddev(self):
+        if self.count == 0:
+            return 0
+        return math.sqrt(max(self.sum_squares / self.count - self.mean ** 2, 0))
+
+    def quantile(self, q):
+        """
+        Returns the q-th quantile of the GPAs, or None if no histogram is kept
+
+        args:
+            float q: the quantile to return, between 0 and 1
+        """
+        if self.histogram is None or self.count == 0:
+            return None
+
+        rank = max(math.ceil(q * self.count), 1)
+        seen = 0
+        for bucket in sorted(self.histogram, key=int):
+            seen += self.histogram[bucket]
+            if seen >= rank:
+                return int(bucket) / 100
+        return self.maximum
+
+    def summary(self):
+        """Summarizes the stats for the API"""
+        return {
+            "count": self.count,
+            "mean": self.mean,
+            "stddev": self.stddev,
+            "min": self.minimum,
+            "max": self.maximum,
+            "median": self.quantile(0.5),
+            "p90": self.quantile(0.9)
+        }
+
+    def to_dict(self):
+        return {
+            "count": self.count,
+            "total": self.total,
+            "sum_squares": self.sum_squares,
+            "minimum": self.minimum,
+            "maximum": self.maximum,
+            "histogram": self.histogram
+        }
+
+    @classmethod
+    def from_dict(cls, data):
+        return cls(data["count"], data["total"], data["sum_squares"],
+                   data["minimum"], data["maximum"], data["histogram"])
+
+
+class StatsAccumulator:
+    """
+    Overall, per-program and per-semester running stats of the GPAs of one
+    event type
+    """
+
+    def __init__(self, quantiles, overall=None, by_program=None, by_semester=None):
+        self.quantiles = quantiles
+        self.overall = overall or self.new_stats()
+        self.by_program = by_program or {}
+        self.by_semester = by_semester or {}
+
+    def new_stats(self):
+        return RunningStats(histogram={} if self.quantiles else None)
+
+    def add(self, value, program, semester):
+        """Adds the GPA of a single event to the stats"""
+        self.overall.add(value)
+        self.by_program.setdefault(program, self.new_stats()).add(value)
+        self.by_semester.setdefault(semester, self.new_stats()).add(value)
+
+    def merge_aggregate(self, aggregate):
+        """
+        Merges an aggregate returned by Storage's aggregates endpoint, along
+        with its by_program and by_semester breakdowns, into the stats
+        """
+        self.overall.merge(RunningStats.from_aggregate(aggregate))
+        for group in aggregate.get("by_program", []):
+            self.by_program.setdefault(group["program"], self.new_stats()) \
+                .merge(RunningStats.from_aggregate(group))
+        for group in aggregate.get("by_semester", []):
+            self.by_semester.setdefault(group["semester"], self.new_stats()) \
+                .merge(RunningStats.from_aggregate(group))
+
+    def breakdown(self, by):
+        """
+        Summarizes the stats of each program or semester
+
+        args:
+            string by: "program" or "semester"
+
+        returns:
+            list: the summary of each group, keyed by the group name
+        """
+        groups = self.by_program if by == "program" else self.by_semester
+        return [{ by: name, **stats.summary() } for name, stats in sorted(groups.items())]
+
+    def to_dict(self):
+        return {
+            "overall": self.overall.to_dict(),
+            "by_program": { name: stats.to_dict() for name, stats in self.by_program.items() },
+            "by_semester": { name: stats.to_dict() for name, stats in self.by_semester.items() }
+        }
+
+    @classmethod
+    def from_dict(cls, quantiles, data):
+        return cls(quantiles,
+                   RunningStats.from_dict(data["overall"]),
+                   { name: RunningStats.from_dict(stats) for name, stats in data["by_program"].items() },
+                   { name: RunningStats.from_dict(stats) for name, stats in data["by_semester"].items() })
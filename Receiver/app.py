@@ -1,14 +1,23 @@
 import logging
-import logging.config
 import yaml
 import uuid
 import json
 import datetime
 import time
+import atexit
 from pykafka import KafkaClient
+from pykafka.common import CompressionType
+from pykafka.partitioners import hashing_partitioner
+from pykafka.exceptions import ProducerQueueFullError
 import os
 import connexion
 from connexion import NoContent
+from connexion.middleware import MiddlewarePosition
+from jsonschema import Draft4Validator
+from ndjson import NDJSON_VALIDATOR_MAP
+from metrics import MetricsMiddleware, counter, histogram
+from log_queue import configure_logging
+import wire
 
 
 APP_CONF_FILE = ""
@@ -28,13 +37,78 @@ with open(APP_CONF_FILE, "r", encoding='utf-8') as f:
 
 with open(LOG_CONF_FILE, "r", encoding='utf-8') as f:
     LOG_CONFIG = yaml.safe_load(f.read())
-    logging.config.dictConfig(LOG_CONFIG)
+    configure_logging(LOG_CONFIG)
 
 logger = logging.getLogger('basicLogger')
+# Per-event payloads, sampled by the payload_sample filter of log_conf.yml
+payload_logger = logging.getLogger('basicLogger.payload')
 
 logger.info("App Conf File: %s", APP_CONF_FILE)
 logger.info("Log Conf File: %s", LOG_CONF_FILE)
 
+COMPRESSION_TYPES = {
+    "none": CompressionType.NONE,
+    "gzip": CompressionType.GZIP,
+    "snappy": CompressionType.SNAPPY,
+    "lz4": CompressionType.LZ4
+}
+
+EVENTS_PRODUCED = counter("events_produced_total", "Events handed to the Kafka producer", ["result"])
+BYTES_PRODUCED = counter("event_bytes_produced_total", "Bytes of encoded events handed to the Kafka producer")
+BATCH_SIZE = histogram("request_batch_size", "Number of events in each batch request",
+                       buckets=(1, 5, 10, 25, 50, 100, 250, 500, 1000))
+
+def create_producer(topic):
+    """
+    Creates the Kafka producer configured in app_conf.yml. In async mode
+    events are queued in memory and sent in compressed batches by a
+    background thread, so requests do not wait on the broker; when the
+    bounded queue is full, produce raises ProducerQueueFullError. Messages
+    are partitioned by a stable hash of their key, so the events of a
+    student always go to the same partition and are consumed in order.
+
+    args:
+        object topic: the Kafka topic to produce to
+
+    returns:
+        object: a sync or async Kafka producer
+    """
+    producer_config = APP_CONFIG['events']['producer']
+    if producer_config['mode'] != "async":
+        return topic.get_sync_producer(partitioner=hashing_partitioner)
+
+    return topic.get_producer(linger_ms=producer_config['linger_ms'],
+                              min_queued_messages=producer_config['batch_size'],
+                              max_queued_messages=producer_config['max_queued_messages'],
+                              compression=COMPRESSION_TYPES[producer_config['compression']],
+                              partitioner=hashing_partitioner,
+                              block_on_queue_full=False)
+
+
+def produce(msg, student_id):
+    """
+    Encodes a message in the wire format configured for the topic and
+    produces it to Kafka, keyed by the student it is about
+
+    args:
+        dict msg: the message, with type, datetime and payload
+        string student_id: the student_id of the event
+
+    returns:
+        bool: False if the producer queue is full and the message was rejected
+    """
+    value = wire.encode(msg, APP_CONFIG['events']['wire_format'])
+    try:
+        producer.produce(value, partition_key=student_id.encode('utf-8'))
+        EVENTS_PRODUCED.inc(result="ok")
+        BYTES_PRODUCED.inc(len(value))
+        return True
+    except ProducerQueueFullError:
+        logger.error("Producer queue is full, rejecting event")
+        EVENTS_PRODUCED.inc(result="queue_full")
+        return False
+
+
 producer = None
 max_retries = APP_CONFIG['events']['retries']
 current_retry = 0
@@ -45,7 +119,7 @@ while current_retry <= max_retries:
         port = APP_CONFIG['events']['port']
         client = KafkaClient(hosts=f"{host}:{port}")
         topic = client.topics[str.encode(APP_CONFIG['events']['topic'])]
-        producer = topic.get_sync_producer()
+        producer = create_producer(topic)
         logger.info("Successfully connected to Kafka broker")
         break
     except:
@@ -53,6 +127,20 @@ while current_retry <= max_retries:
         time.sleep(APP_CONFIG['events']['retry_delay'])
         current_retry += 1
 
+# Batch events are validated individually against the same schemas as the
+# single event endpoints, so one invalid event does not reject the batch
+with open("openapi.yaml", "r", encoding='utf-8') as f:
+    SCHEMAS = yaml.safe_load(f.read())['components']['schemas']
+
+EVENT_VALIDATORS = {
+    "enroll": Draft4Validator(SCHEMAS['StudentEnrollment']),
+    "drop_out": Draft4Validator(SCHEMAS['StudentDropOut'])
+}
+
+# Flush any queued events to the broker before the process exits
+if producer is not None:
+    atexit.register(producer.stop)
+
 def enroll_student(body):
     """
     Receives a request with an enroll event type and produces a
@@ -63,7 +151,8 @@ def enroll_student(body):
     
     returns:
         object: a NoContent connexion object
-        int: a 201 status code saying the event was created
+        int: a 201 status code saying the event was created, or 503 if
+            the event queue is full
         
     """
     body["trace_id"] = str(uuid.uuid4())
@@ -76,10 +165,9 @@ def enroll_student(body):
         "payload": body
     }
 
-    msg_str = json.dumps(msg)
-    logger.info(msg_str)
-    global producer
-    producer.produce(msg_str.encode('utf-8'))
+    payload_logger.info("Message: %s", msg)
+    if not produce(msg, body['student_id']):
+        return { "message": "Event queue is full, retry later" }, 503
 
     return NoContent, 201
 
@@ -93,7 +181,8 @@ def withdraw_student(body):
     
     returns:
         object: a NoContent connexion object
-        int: a 201 status code saying the event was created
+        int: a 201 status code saying the event was created, or 503 if
+            the event queue is full
 
     """
     body["trace_id"] = str(uuid.uuid4())
@@ -108,22 +197,140 @@ def withdraw_student(body):
         "payload": body
     }
 
-    msg_str = json.dumps(msg)
-    logger.info(msg_str)
-    global producer
-    producer.produce(msg_str.encode('utf-8'))
+    payload_logger.info("Message: %s", msg)
+    if not produce(msg, body['student_id']):
+        return { "message": "Event queue is full, retry later" }, 503
 
     # logger.info(f"Returned event drop-out response (id: {body["trace_id"]}) with status 201")
 
     return NoContent, 201
 
+def parse_batch(body):
+    """
+    Splits a batch request body into its events. JSON bodies are already
+    parsed into a list by connexion; NDJSON bodies hold one event per line.
+
+    args:
+        object body: the request body, a list or NDJSON bytes
+
+    returns:
+        list: the events, with a ValueError in place of each unparseable line
+    """
+    if isinstance(body, list):
+        return body
+
+    if isinstance(body, bytes):
+        body = body.decode('utf-8')
+
+    events = []
+    for line in body.splitlines():
+        if not line.strip():
+            continue
+        try:
+            events.append(json.loads(line))
+        except ValueError as e:
+            events.append(e)
+    return events
+
+
+def produce_batch(event_type, body):
+    """
+    Validates each event of a batch against its schema and produces the
+    valid ones to Kafka, each with its own trace id. Invalid events are
+    reported without rejecting the rest of the batch.
+
+    args:
+        string event_type: "enroll" or "drop_out"
+        object body: the request body, a list or NDJSON bytes
+
+    returns:
+        object: the trace id or error of each event, in request order
+        int: a 201 status code if every event was created, 207 if some were
+            rejected, 413 if the batch is too large
+    """
+    events = parse_batch(body)
+    BATCH_SIZE.observe(len(events))
+
+    if len(events) > APP_CONFIG['events']['max_batch_size']:
+        return { "message": f"Batch exceeds {APP_CONFIG['events']['max_batch_size']} events" }, 413
+
+    validator = EVENT_VALIDATORS[event_type]
+    results = []
+    num_created = 0
+
+    for index, event in enumerate(events):
+        if isinstance(event, ValueError):
+            results.append({ "index": index, "status": 400, "error": f"Invalid JSON: {event}" })
+            continue
+
+        error = next(validator.iter_errors(event), None)
+        if error is not None:
+            results.append({ "index": index, "status": 400, "error": error.message })
+            continue
+
+        event["trace_id"] = str(uuid.uuid4())
+        msg = {
+            "type": event_type,
+            "datetime": datetime.datetime.now().strftime("%Y-%m-%dT%H:%M:%S"),
+            "payload": event
+        }
+        if not produce(msg, event['student_id']):
+            results.append({ "index": index, "status": 503, "trace_id": event["trace_id"],
+                             "error": "Event queue is full, retry later" })
+            continue
+
+        results.append({ "index": index, "status": 201, "trace_id": event["trace_id"] })
+        num_created += 1
+
+    logger.info("Received batch of %d %s events, %d created", len(events), event_type, num_created)
+
+    status = 201 if num_created == len(events) else 207
+    return { "created": num_created, "rejected": len(events) - num_created, "results": results }, status
+
+
+def enroll_students(body):
+    """
+    Receives a request with a batch of enroll events and produces a
+    Kafka message for each valid event.
+
+    args:
+        object body: the request body, a JSON array or NDJSON
+
+    returns:
+        object: the trace id or error of each event
+        int: a 201 status code if every event was created, 207 if some were
+            rejected
+
+    """
+    return produce_batch("enroll", body)
+
+
+def withdraw_students(body):
+    """
+    Receives a request with a batch of drop_out events and produces a
+    Kafka message for each valid event.
+
+    args:
+        object body: the request body, a JSON array or NDJSON
+
+    returns:
+        object: the trace id or error of each event
+        int: a 201 status code if every event was created, 207 if some were
+            rejected
+
+    """
+    return produce_batch("drop_out", body)
+
 def get_check():
     return NoContent, 200
 
 
 app = connexion.FlaskApp(__name__, specification_dir='')
-app.add_api("openapi.yaml", base_path="/receiver", strict_validation=True, validate_responses=True)
+app.add_api("openapi.yaml", base_path="/receiver", strict_validation=True, validate_responses=True,
+            validator_map=NDJSON_VALIDATOR_MAP)
+app.add_middleware(MetricsMiddleware, position=MiddlewarePosition.BEFORE_EXCEPTION, path="/receiver/metrics",
+                   shared_dir=APP_CONFIG['server']['metrics_dir'])
 
 if __name__ == "__main__":
-    logger.info("Receiver service running on port 8080")
-    app.run(port=8080, host="0.0.0.0")
+    logger.info("Receiver service running on port %d", APP_CONFIG['server']['port'])
+    app.run(port=APP_CONFIG['server']['port'], host="0.0.0.0")
@@ -0,0 +1,330 @@
+import bisect
+import json
+import logging
+import os
+import threading
+import time
+from contextlib import contextmanager
+
+logger = logging.getLogger('basicLogger')
+
+# Seconds, from fast in-memory reads up to slow database and broker calls
+DEFAULT_BUCKETS = (0.001, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10)
+
+# Seconds between the snapshots each worker process writes for the others
+SHARE_INTERVAL = 5
+
+
+class Metric:
+    """
+    A named metric with one value per combination of label values. Updates
+    take a short uncontended lock, so recording a value costs well under a
+    microsecond on the hot path; all formatting is left to scrape time.
+    """
+
+    kind = None
+
+    def __init__(self, name, description, labels=()):
+        self.name = name
+        self.description = description
+        self.label_names = tuple(labels)
+        self.lock = threading.Lock()
+        self.values = {}
+
+    def key(self, labels):
+        return tuple(str(labels.get(name, "")) for name in self.label_names)
+
+    def format_labels(self, key, extra=()):
+        pairs = list(zip(self.label_names, key)) + list(extra)
+        if not pairs:
+            return ""
+        return "{" + ",".join('%s="%s"' % (name, value.replace('"', '\\"')) for name, value in pairs) + "}"
+
+    def snapshot(self):
+        with self.lock:
+            return dict(self.values)
+
+    def merge(self, values, key, value):
+        """Adds the value of another process to values"""
+        values[key] = values.get(key, 0) + value
+
+    def render(self, values=None):
+        lines = [f"# HELP {self.name} {self.description}", f"# TYPE {self.name} {self.kind}"]
+        for key, value in sorted((values if values is not None else self.snapshot()).items()):
+            lines.extend(self.render_value(key, value))
+        return lines
+
+    def render_value(self, key, value):
+        return [f"{self.name}{self.format_labels(key)} {value}"]
+
+
+class Counter(Metric):
+    """A count that only goes up, such as the number of events stored"""
+
+    kind = "counter"
+
+    def inc(self, amount=1, **labels):
+        key = self.key(labels)
+        with self.lock:
+            self.values[key] = self.values.get(key, 0) + amount
+
+
+class Gauge(Metric):
+    """A value that goes up and down, such as the consumer lag"""
+
+    kind = "gauge"
+
+    def set(self, value, **labels):
+        key = self.key(labels)
+        with self.lock:
+            self.values[key] = value
+
+
+class Histogram(Metric):
+    """
+    Counts observations, such as durations or batch sizes, in cumulative
+    buckets so percentiles can be estimated from the scraped counts
+    """
+
+    kind = "histogram"
+
+    def __init__(self, name, description, labels=(), buckets=DEFAULT_BUCKETS):
+        super().__init__(name, description, labels)
+        self.buckets = tuple(buckets)
+
+    def observe(self, value, **labels):
+        key = self.key(labels)
+        index = bisect.bisect_left(self.buckets, value)
+        with self.lock:
+            counts = self.values.get(key)
+            if counts is None:
+                # one count per bucket plus +Inf, then the sum
+                counts = self.values[key] = [0] * (len(self.buckets) + 1) + [0.0]
+            counts[index] += 1
+            counts[-1] += value
+
+    @contextmanager
+    def time(self, **labels):
+        """Observes the duration of the with block in seconds"""
+        start = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.observe(time.perf_counter() - start, **labels)
+
+    def snapshot(self):
+        with self.lock:
+            return { key: list(counts) for key, counts in self.values.items() }
+
+    def merge(self, values, key, value):
+        counts = values.get(key)
+        values[key] = value if counts is None else [a + b for a, b in zip(counts, value)]
+
+    def render_value(self, key, counts):
+        lines = []
+        cumulative = 0
+        for bound, count in zip(self.buckets + (float("inf"),), counts):
+            cumulative += count
+            le = "+Inf" if bound == float("inf") else repr(float(bound))
+            lines.append(f"{self.name}_bucket{self.format_labels(key, [('le', le)])} {cumulative}")
+        lines.append(f"{self.name}_sum{self.format_labels(key)} {counts[-1]}")
+        lines.append(f"{self.name}_count{self.format_labels(key)} {cumulative}")
+        return lines
+
+
+def process_alive(pid):
+    try:
+        os.kill(pid, 0)
+    except ProcessLookupError:
+        return False
+    except PermissionError:
+        pass
+    return True
+
+
+class Registry:
+    """
+    The metrics of a service, rendered together in the Prometheus text
+    format. When the service runs several worker processes, each one only
+    counts what it did itself, so the registry of every worker can share its
+    values through a directory: each writes a snapshot there every
+    SHARE_INTERVAL seconds, and a scrape served by any worker adds up its
+    own values and the latest snapshot of every other. The counters and
+    histograms of exited workers are kept in the sum so they never go
+    backwards; their gauges are left out.
+    """
+
+    def __init__(self):
+        self.metrics = []
+        self.shared_dir = None
+
+    def register(self, metric):
+        self.metrics.append(metric)
+        return metric
+
+    def share(self, directory, interval=SHARE_INTERVAL):
+        """Starts sharing the values of this process through directory"""
+        if self.shared_dir is not None:
+            return
+        os.makedirs(directory, exist_ok=True)
+        self.shared_dir = directory
+        threading.Thread(target=self.write_snapshots, args=(interval,), daemon=True).start()
+
+    def snapshot_file(self, pid):
+        return os.path.join(self.shared_dir, f"{pid}.json")
+
+    def write_snapshots(self, interval):
+        path = self.snapshot_file(os.getpid())
+        while True:
+            snapshot = { metric.name: [[list(key), value] for key, value in metric.snapshot().items()]
+                         for metric in self.metrics }
+            try:
+                with open(path + ".tmp", "w", encoding="utf-8") as f:
+                    json.dump(snapshot, f)
+                os.replace(path + ".tmp", path)
+            except OSError as e:
+                logger.error("Could not write metrics snapshot %s: %s", path, e)
+            time.sleep(interval)
+
+    def merged(self):
+        """Returns the values of each metric by name, summed over every worker process"""
+        values = { metric.name: metric.snapshot() for metric in self.metrics }
+        metrics = { metric.name: metric for metric in self.metrics }
+
+        for filename in os.listdir(self.shared_dir):
+            if not filename.endswith(".json"):
+                continue
+            pid = int(filename[:-len(".json")])
+            if pid == os.getpid():
+                continue
+            alive = process_alive(pid)
+            try:
+                with open(os.path.join(self.shared_dir, filename), "r", encoding="utf-8") as f:
+                    snapshot = json.load(f)
+            except (OSError, ValueError):
+                continue
+
+            for name, metric_values in snapshot.items():
+                metric = metrics.get(name)
+                if metric is None or (metric.kind == "gauge" and not alive):
+                    continue
+                for key, value in metric_values:
+                    metric.merge(values[name], tuple(key), value)
+
+        return values
+
+    def render(self):
+        values = self.merged() if self.shared_dir is not None else {}
+        lines = []
+        for metric in self.metrics:
+            lines.extend(metric.render(values.get(metric.name)))
+        return "\n".join(lines) + "\n"
+
+
+REGISTRY = Registry()
+
+
+def counter(name, description, labels=()):
+    return REGISTRY.register(Counter(name, description, labels))
+
+
+def gauge(name, description, labels=()):
+    return REGISTRY.register(Gauge(name, description, labels))
+
+
+def histogram(name, description, labels=(), buckets=DEFAULT_BUCKETS):
+    return REGISTRY.register(Histogram(name, description, labels, buckets))
+
+
+REQUEST_LATENCY = histogram("http_request_duration_seconds",
+                            "Latency of HTTP requests by the operationId that served them",
+                            ["operation_id", "method", "status"])
+
+
+class MetricsMiddleware:
+    """
+    ASGI middleware for a connexion app that times every request by the
+    operationId connexion routed it to, and serves the metrics of the
+    service in the Prometheus text format at path. Add it before connexion's
+    exception middleware so failed requests are timed too:
+
+        app.add_middleware(MetricsMiddleware, position=MiddlewarePosition.BEFORE_EXCEPTION,
+                           path="/storage/metrics", shared_dir="/tmp/storage_metrics")
+
+    With several worker processes, pass shared_dir so every scrape reports
+    the metrics of all of them, see Registry.
+    """
+
+    def __init__(self, app, path="/metrics", shared_dir=None):
+        self.app = app
+        self.path = path
+        if shared_dir is not None:
+            REGISTRY.share(shared_dir)
+
+    async def __call__(self, scope, receive, send):
+        if scope["type"] != "http":
+            await self.app(scope, receive, send)
+            return
+
+        if scope["path"] == self.path:
+            body = REGISTRY.render().encode("utf-8")
+            await send({
+                "type": "http.response.start",
+                "status": 200,
+                "headers": [(b"content-type", b"text/plain; version=0.0.4; charset=utf-8"),
+                            (b"content-length", str(len(body)).encode())]
+            })
+            await send({ "type": "http.response.body", "body": body })
+            return
+
+        # connexion's routing records the operation in the extensions of a
+        # shallow copy of the scope, so share the dict to read it afterwards
+        extensions = scope.setdefault("extensions", {})
+        status = [500]
+
+        async def send_with_status(message):
+            if message["type"] == "http.response.start":
+                status[0] = message["status"]
+            await send(message)
+
+        start = time.perf_counter()
+        try:
+            await self.app(scope, receive, send_with_status)
+        finally:
+            operation_id = extensions.get("connexion_routing", {}).get("operation_id") or "unrouted"
+            REQUEST_LATENCY.observe(time.perf_counter() - start, operation_id=operation_id,
+                                    method=scope["method"], status=status[0])
+
+
+KAFKA_CONSUMER_LAG = gauge("kafka_consumer_lag",
+                           "Messages between the last consumed offset and the end of each partition",
+                           ["group", "partition"])
+
+
+class ConsumerLag:
+    """
+    Tracks how many messages a pykafka consumer is behind the end of each
+    partition. Looking up the latest offsets is a broker round trip, so it
+    is done at most every interval seconds from the consumer's own thread.
+    """
+
+    def __init__(self, group, interval):
+        self.group = group
+        self.interval = interval
+        self.next_update = 0
+        self.gauge = KAFKA_CONSUMER_LAG
+
+    def update(self, consumer):
+        now = time.monotonic()
+        if now < self.next_update:
+            return
+        self.next_update = now + self.interval
+
+        try:
+            latest = consumer.topic.latest_available_offsets()
+            for partition_id, offset in consumer.held_offsets.items():
+                consumed = max(offset, -1)
+                self.gauge.set(latest[partition_id].offset[0] - consumed - 1,
+                               group=self.group, partition=partition_id)
+        except Exception as e:
+            logger.debug("Could not update consumer lag: %s", e)
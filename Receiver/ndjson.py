@@ -0,0 +1,24 @@
+from connexion.datastructures import MediaTypeDict
+from connexion.validators import VALIDATOR_MAP, AbstractRequestBodyValidator
+
+
+class NDJSONRequestBodyValidator(AbstractRequestBodyValidator):
+    """
+    Passes application/x-ndjson request bodies through to the handler,
+    which validates each line on its own so one invalid event does not
+    reject the whole batch
+    """
+
+    async def _parse(self, stream, scope):
+        async for _ in stream:
+            pass
+
+
+# Connexion's default validators with NDJSON added, since the default JSON
+# validator would try to parse the whole body as a single document
+NDJSON_VALIDATOR_MAP = {
+    "body": MediaTypeDict({
+        **VALIDATOR_MAP["body"],
+        "application/x-ndjson": NDJSONRequestBodyValidator
+    })
+}
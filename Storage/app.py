@@ -4,20 +4,31 @@ import time
 
 import yaml
 import logging
-import logging.config
 import json
 
-from sqlalchemy import create_engine, and_
+from sqlalchemy import create_engine, and_, case, delete, func, insert, tuple_
+from sqlalchemy.dialects.mysql import insert as upsert
+from sqlalchemy.exc import DBAPIError, InterfaceError, OperationalError
 from sqlalchemy.orm import sessionmaker
 from base import Base
 from enroll import Enroll
 from drop_out import DropOut
+from event_stats import EventStats
+from program_stats import ProgramStats
+from ndjson import NDJSON_VALIDATOR_MAP
+from metrics import MetricsMiddleware, ConsumerLag, counter, histogram
+from log_queue import configure_logging
+from leader import leader_lifespan
+from cache import DataVersion, QueryCache
+import wire
 
 from pykafka import KafkaClient
 from pykafka.common import OffsetType
-from threading import Thread
+from threading import Lock, Thread
 import connexion
-from connexion import NoContent
+from connexion.middleware import MiddlewarePosition
+from connexion.jsonifier import JSONEncoder
+from flask import Response
 
 
 APP_CONF_FILE = ""
@@ -37,9 +48,37 @@ with open(APP_CONF_FILE, "r", encoding='utf-8') as f:
 
 with open(LOG_CONF_FILE, "r", encoding='utf-8') as f:
         LOG_CONFIG = yaml.safe_load(f.read())
-        logging.config.dictConfig(LOG_CONFIG)
+        configure_logging(LOG_CONFIG)
 
 logger = logging.getLogger('basicLogger')
+# Per-event payloads, sampled by the payload_sample filter of log_conf.yml
+payload_logger = logging.getLogger('basicLogger.payload')
+
+CURSOR_FORMAT = "%Y-%m-%dT%H:%M:%S.%f"
+
+DB_QUERY_TIME = histogram("db_query_duration_seconds", "Time spent in database queries and inserts", ["query"])
+BATCH_SIZE = histogram("consumer_batch_size", "Number of Kafka messages in each stored batch",
+                       buckets=(1, 5, 10, 25, 50, 100, 250, 500, 1000))
+EVENTS_STORED = counter("events_stored_total", "Events stored in the database", ["event_type"])
+EVENTS_REJECTED = counter("events_rejected_total", "Events the database rejected, logged and skipped",
+                          ["event_type"])
+
+# Readers page through new events by id (after_id), which is only safe if
+# rows become visible in id order, so the consumer workers take turns to
+# insert and commit while decoding and fetching from Kafka in parallel
+INSERT_LOCK = Lock()
+
+# The id of the single row of event_stats
+STATS_ID = 1
+# The tables counted in the stats, by event type, with their GPA columns
+STATS_MODELS = (("enroll", Enroll, Enroll.highschool_gpa), ("drop_out", DropOut, DropOut.program_gpa))
+
+# Results of the read endpoints, shared by the requests of this worker
+# process and invalidated by the consumers' commits in any worker
+CACHE_CONFIG = APP_CONFIG['cache']
+DATA_VERSION = DataVersion(CACHE_CONFIG['version_file'])
+QUERY_CACHE = QueryCache(DATA_VERSION, CACHE_CONFIG['ttl_sec'], CACHE_CONFIG['max_entries'],
+                         enabled=CACHE_CONFIG['enabled'])
 
 logger.info("App Conf File: %s",  APP_CONF_FILE)
 logger.info("Log Conf File: %s", LOG_CONF_FILE)
@@ -65,224 +104,762 @@ DB_SESSION = sessionmaker(bind=DB_ENGINE)
 
 logger.info("Connecting to DB. Hostname:%s, Port:%s", host, port)
 
-def enroll_student(payload):
+def parse_cursor(cursor):
     """
-    Stores enroll events in the enroll table
+    Splits a pagination cursor into the keys of the last row already returned
 
     args:
-        object payload: the payload from the Kafka message containing the event
-    
+        string cursor: a cursor from the X-Next-Cursor header of a previous page
+
     returns:
-        object: A NoContent connexion object
-        int: a 201 status code saying the events were stored successfully
-        
+        tuple: the (date_created, id) keyset of the last returned row
+
+    raises:
+        ValueError: if the cursor is malformed
     """
-    session = DB_SESSION()
+    date_created, event_id = cursor.split("|")
+    return datetime.strptime(date_created, CURSOR_FORMAT), int(event_id)
 
-    try:
-        enrolled_student = Enroll(payload['student_id'],
-                                payload['program'],
-                                payload['highschool_gpa'],
-                                datetime.strptime(payload['student_acceptance_date'], "%m-%d-%Y"),
-                                datetime.strptime(payload['program_starting_date'], "%m-%d-%Y"),
-                                payload['trace_id'])
-
-        session.add(enrolled_student)
-        session.commit()
 
-        logger.debug("Stored event enroll with a trace id of %s", payload['trace_id'])
-    except Exception as e:
-        session.rollback()
-        print(e)
-    finally:
-        session.close()
-        return NoContent, 201
+def make_cursor(keyset):
+    """Builds the pagination cursor for a (date_created, id) keyset"""
+    return f"{keyset[0].strftime(CURSOR_FORMAT)}|{keyset[1]}"
 
 
-def withdraw_student(payload):
+def window_query(session, model, start_datetime, end_datetime, after, after_id=None):
     """
-    Stores drop_out events in the drop_out table
+    Builds a query for the rows of a table created within a timeframe, ordered
+    by (date_created, id) so it is served by the table's date_created index
+    and can be resumed from a keyset without an OFFSET scan. When after_id is
+    given the rows with a greater id are queried instead, ordered by id, so
+    callers can track a high-water mark on the auto-increment id that is
+    served by a primary key range scan and unaffected by clock skew.
 
     args:
-        object payload: the payload from the Kafka message containing the event
-    
+        object session: the database session to query with
+        class model: the Enroll or DropOut model to query
+        datetime start_datetime: the start of the timeframe
+        datetime end_datetime: the end of the timeframe
+        tuple after: the (date_created, id) keyset to resume after, or None
+        int after_id: the id to return the rows after instead of the timeframe, or None
+
     returns:
-        object: A NoContent connexion object
-        int: a 201 status code saying the events were stored successfully
-        
+        object: the ordered query
     """
-    session = DB_SESSION()
+    if after_id is not None:
+        return session.query(model).filter(model.id > after_id).order_by(model.id)
 
-    try:
-        withdrawn_student = DropOut(payload['student_id'],
-                                    payload['program'],
-                                    payload['program_gpa'],
-                                    datetime.strptime(payload['student_dropout_date'], "%m-%d-%Y"),
-                                    payload['trace_id'])
+    query = session.query(model).filter(
+            and_(model.date_created >= start_datetime,
+            model.date_created < end_datetime))
 
-        session.add(withdrawn_student)
+    if after is not None:
+        query = query.filter(tuple_(model.date_created, model.id) > after)
 
-        session.commit()
-        logger.debug("Stored event drop-out with a trace id of %s", {payload['trace_id']})
-    except Exception as e:
-        session.rollback()
-        print(e)
-    finally:
-        session.close()
-        return NoContent, 201
+    return query.order_by(model.date_created, model.id)
 
 
-def get_enroll_student(start_timestamp, end_timestamp):
+def stream_events(model, start_datetime, end_datetime, after, after_id, limit):
     """
-    Receives a GET request with a start time and end time
-    and retrieves enroll events created within that timeframe
+    Yields the rows of a timeframe as NDJSON lines, fetching them in keyset
+    chunks of stream_chunk_size rows so memory stays flat regardless of the
+    size of the timeframe
 
     args:
+        class model: the Enroll or DropOut model to query
+        datetime start_datetime: the start of the timeframe
+        datetime end_datetime: the end of the timeframe
+        tuple after: the (date_created, id) keyset to resume after, or None
+        int after_id: the id to yield the rows after instead of the timeframe, or None
+        int limit: the maximum number of rows to yield, or None for all
+
+    yields:
+        string: one JSON encoded event per line
+    """
+    chunk_size = APP_CONFIG['datastore']['stream_chunk_size']
+    remaining = limit
+
+    while remaining is None or remaining > 0:
+        size = chunk_size if remaining is None else min(chunk_size, remaining)
+
+        session = DB_SESSION()
+        try:
+            rows = window_query(session, model, start_datetime, end_datetime, after, after_id).limit(size).all()
+            for row in rows:
+                yield json.dumps(row.to_dict(), cls=JSONEncoder) + "\n"
+        finally:
+            session.close()
+
+        if len(rows) < size:
+            return
+
+        if after_id is not None:
+            after_id = rows[-1].id
+        else:
+            after = (rows[-1].date_created, rows[-1].id)
+        if remaining is not None:
+            remaining -= len(rows)
+
+
+def get_events(model, start_timestamp, end_timestamp, limit, cursor, after_id):
+    """
+    Retrieves the events of a table created within a timeframe, or with an id
+    greater than after_id, either as a JSON list or, when the client accepts
+    application/x-ndjson, as a stream. For a timeframe, when a limit is given
+    and more rows remain, the X-Next-Cursor response header holds the cursor
+    for the next page. For after_id, the X-Last-Id response header holds the
+    id of the last event returned, to pass as after_id next time.
+
+    args:
+        class model: the Enroll or DropOut model to query
         string start_timestamp: the start of the timeframe
         string end_timestamp: the end of the timeframe
-    
+        int limit: the maximum number of events to return, or None for all
+        string cursor: the cursor returned with the previous page, or None
+        int after_id: the id to return the events after instead of the timeframe, or None
+
     returns:
         list: A list of events created within the timeframe
         int: a 200 status code saying the events were retrieved
-        
+        dict: the pagination response headers
     """
-    logger.info("received request")
-    session = DB_SESSION()
+    start_timestamp_datetime = end_timestamp_datetime = after = None
+    try:
+        if after_id is not None:
+            if cursor is not None:
+                raise ValueError("cursor cannot be combined with after_id, page with after_id instead")
+        elif start_timestamp is None or end_timestamp is None:
+            raise ValueError("start_timestamp and end_timestamp are required without after_id")
+        else:
+            start_timestamp_datetime = datetime.strptime(start_timestamp, "%Y-%m-%dT:%H:%M:%S")
+            end_timestamp_datetime = datetime.strptime(end_timestamp, "%Y-%m-%dT:%H:%M:%S")
+            after = parse_cursor(cursor) if cursor is not None else None
+    except ValueError as e:
+        logger.error("Invalid query for %s events: %s", model.__tablename__, e)
+        return { "message": str(e) }, 400, {"Content-Type": "application/json"}
+
+    if "application/x-ndjson" in connexion.request.headers.get("Accept", ""):
+        logger.info("Streaming %s events from %s", model.__tablename__, start_timestamp_datetime or after_id)
+        return Response(stream_events(model, start_timestamp_datetime, end_timestamp_datetime, after, after_id, limit),
+                        mimetype="application/x-ndjson")
+
+    def load():
+        session = DB_SESSION()
+
+        query = window_query(session, model, start_timestamp_datetime, end_timestamp_datetime, after, after_id)
+        if limit is not None:
+            query = query.limit(limit)
+
+        with DB_QUERY_TIME.time(query="events"):
+            results = query.all()
+        results_list = [reading.to_dict() for reading in results]
 
-    logger.debug(start_timestamp)
-    logger.debug(end_timestamp)
+        session.close()
 
-    try:
-        start_timestamp_datetime = datetime.strptime(start_timestamp, "%Y-%m-%dT:%H:%M:%S")
-        end_timestamp_datetime = datetime.strptime(end_timestamp, "%Y-%m-%dT:%H:%M:%S")
-        logger.debug(start_timestamp_datetime)
-        logger.debug(end_timestamp_datetime)
-        results = session.query(Enroll).filter(
-                and_(Enroll.date_created >= start_timestamp_datetime,
-                Enroll.date_created < end_timestamp_datetime))
-    except Exception as e:
-        logger.debug(e)
+        headers = {"Content-Type": "application/json"}
+        if after_id is not None:
+            headers["X-Last-Id"] = str(results[-1].id if results else after_id)
+        elif limit is not None and len(results) == limit:
+            headers["X-Next-Cursor"] = make_cursor((results[-1].date_created, results[-1].id))
 
-    results_list = []
+        return results_list, headers
 
-    for reading in results:
-        results_list.append(reading.to_dict())
+    results_list, headers = QUERY_CACHE.get_or_load(
+        ("events", model.__tablename__, start_timestamp_datetime, end_timestamp_datetime, after, after_id, limit),
+        load, cache_if=lambda result: len(result[0]) <= CACHE_CONFIG['max_rows'])
 
-    logger.debug("\nRESULTS RECEIVED")
-    logger.debug(results_list)
+    logger.info("Query for %s events %s returns %d results",
+                model.__tablename__, start_timestamp_datetime or after_id, len(results_list))
 
-    session.close()
+    return results_list, 200, dict(headers)
 
-    logger.info("Query for enrolled students %s returns %d results", start_timestamp_datetime, len(results_list))
 
-    return results_list, 200
+def get_enroll_student(start_timestamp=None, end_timestamp=None, limit=None, cursor=None, after_id=None):
+    """
+    Receives a GET request with a start time and end time
+    and retrieves enroll events created within that timeframe,
+    or the events with an id greater than after_id
 
+    args:
+        string start_timestamp: the start of the timeframe
+        string end_timestamp: the end of the timeframe
+        int limit: the maximum number of events to return
+        string cursor: the cursor returned with the previous page
+        int after_id: the id to return the events after instead of the timeframe
+    
+    returns:
+        list: A list of events created within the timeframe
+        int: a 200 status code saying the events were retrieved
+        
+    """
+    logger.info("received request")
 
-def get_drop_out_student(start_timestamp, end_timestamp):
+    return get_events(Enroll, start_timestamp, end_timestamp, limit, cursor, after_id)
+
+
+def get_drop_out_student(start_timestamp=None, end_timestamp=None, limit=None, cursor=None, after_id=None):
     """
     Receives a GET request with a start time and end time
-    and retrieves drop_out events created within that timeframe
+    and retrieves drop_out events created within that timeframe,
+    or the events with an id greater than after_id
 
     args:
         string start_timestamp: the start of the timeframe
         string end_timestamp: the end of the timeframe
+        int limit: the maximum number of events to return
+        string cursor: the cursor returned with the previous page
+        int after_id: the id to return the events after instead of the timeframe
     
     returns:
         list: A list of events created within the timeframe
         int: a 200 status code saying the events were retrieved
         
     """
-    session = DB_SESSION()
+    return get_events(DropOut, start_timestamp, end_timestamp, limit, cursor, after_id)
+
+def semester_of(date_column):
+    """
+    Builds a SQL expression naming the semester a date falls in, such as
+    "2025 Winter" for January to April, "2025 Summer" for May to August and
+    "2025 Fall" for September to December
+    """
+    month = func.month(date_column)
+    term = case((month <= 4, "Winter"), (month <= 8, "Summer"), else_="Fall")
+    return func.concat(func.year(date_column), " ", term)
 
-    start_timestamp_datetime = datetime.strptime(start_timestamp, "%Y-%m-%dT:%H:%M:%S")
-    end_timestamp_datetime = datetime.strptime(end_timestamp, "%Y-%m-%dT:%H:%M:%S")
 
-    results = session.query(DropOut).filter(
-            and_(DropOut.date_created >= start_timestamp_datetime,
-            DropOut.date_created < end_timestamp_datetime))
+def aggregate_window(session, model, gpa_column, date_column, start_datetime, end_datetime, group_by,
+                     after_id=None):
+    """
+    Computes the count, sum, sum of squares, min and max of a GPA column over
+    the rows of a table created within a timeframe, or with an id greater
+    than after_id, in the database. The greatest id aggregated is returned
+    as last_id, and the breakdowns are bounded by it so they cover exactly
+    the same rows even while new rows are inserted.
 
-    results_list = []
+    args:
+        object session: the database session to query with
+        class model: the Enroll or DropOut model to query
+        object gpa_column: the GPA column of the model to aggregate
+        object date_column: the date column that decides an event's semester
+        datetime start_datetime: the start of the timeframe
+        datetime end_datetime: the end of the timeframe
+        list group_by: "program" and/or "semester" to also break the aggregates down by
+        int after_id: the id to aggregate the rows after instead of the timeframe, or None
+
+    returns:
+        dict: the aggregates of the timeframe
+    """
+    columns = (func.count(model.id), func.sum(gpa_column), func.sum(gpa_column * gpa_column),
+               func.min(gpa_column), func.max(gpa_column))
+    if after_id is not None:
+        window = model.id > after_id
+    else:
+        window = and_(model.date_created >= start_datetime, model.date_created < end_datetime)
+
+    row = session.query(*columns, func.max(model.id)).filter(window).one()
+    aggregates = to_aggregate(row[:-1])
+    last_id = row[-1]
+    aggregates["last_id"] = last_id if last_id is not None else after_id
+    if last_id is not None:
+        window = and_(window, model.id <= last_id)
+
+    for field in group_by or []:
+        key = model.program if field == "program" else semester_of(date_column)
+        rows = session.query(key, *columns).filter(window).group_by(key)
+        aggregates[f"by_{field}"] = [{ field: row[0], **to_aggregate(row[1:]) } for row in rows]
+
+    return aggregates
+
+
+def to_aggregate(row):
+    """Converts a (count, sum, sum of squares, min, max) result row into a JSON ready dict"""
+    count, total, sum_squares, minimum, maximum = row
+    return {
+        "count": count,
+        "sum": float(total) if total is not None else 0,
+        "sum_squares": float(sum_squares) if sum_squares is not None else 0,
+        "min": float(minimum) if minimum is not None else None,
+        "max": float(maximum) if maximum is not None else None
+    }
+
+
+def get_aggregates(start_timestamp=None, end_timestamp=None, group_by=None,
+                   enroll_after_id=None, drop_out_after_id=None):
+    """
+    Receives a GET request with a start time and end time and returns
+    the GPA aggregates of the enroll and drop_out events created within
+    that timeframe, so callers do not have to fetch the rows themselves.
+    An event type's after_id, when given, replaces the timeframe for that
+    type with the events with a greater id.
 
-    for reading in results:
-        results_list.append(reading.to_dict())
+    args:
+        string start_timestamp: the start of the timeframe
+        string end_timestamp: the end of the timeframe
+        list group_by: "program" and/or "semester" to also break the aggregates down by
+        int enroll_after_id: the enroll id to aggregate the events after
+        int drop_out_after_id: the drop_out id to aggregate the events after
 
-    session.close()
+    returns:
+        dict: the enroll and drop_out aggregates of the timeframe
+        int: a 200 status code saying the aggregates were computed
+    """
+    start_timestamp_datetime = end_timestamp_datetime = None
+    try:
+        if enroll_after_id is None or drop_out_after_id is None:
+            if start_timestamp is None or end_timestamp is None:
+                raise ValueError("start_timestamp and end_timestamp are required without both after ids")
+            start_timestamp_datetime = datetime.strptime(start_timestamp, "%Y-%m-%dT:%H:%M:%S")
+            end_timestamp_datetime = datetime.strptime(end_timestamp, "%Y-%m-%dT:%H:%M:%S")
+    except ValueError as e:
+        logger.error("Invalid query for aggregates: %s", e)
+        return { "message": str(e) }, 400
+
+    def load():
+        session = DB_SESSION()
 
-    logger.info("Query for drop out students %s returns %d results", start_timestamp, len(results_list))
+        try:
+            with DB_QUERY_TIME.time(query="aggregates"):
+                return {
+                    "enroll": aggregate_window(session, Enroll, Enroll.highschool_gpa, Enroll.program_starting_date,
+                                               start_timestamp_datetime, end_timestamp_datetime, group_by,
+                                               enroll_after_id),
+                    "drop_out": aggregate_window(session, DropOut, DropOut.program_gpa, DropOut.student_dropout_date,
+                                                 start_timestamp_datetime, end_timestamp_datetime, group_by,
+                                                 drop_out_after_id)
+                }
+        finally:
+            session.close()
+
+    aggregates = QUERY_CACHE.get_or_load(
+        ("aggregates", start_timestamp_datetime, end_timestamp_datetime, tuple(group_by or ()),
+         enroll_after_id, drop_out_after_id),
+        load)
+
+    logger.info("Aggregates from %s cover %d enroll and %d drop out events",
+                start_timestamp_datetime or (enroll_after_id, drop_out_after_id),
+                aggregates["enroll"]["count"], aggregates["drop_out"]["count"])
+
+    return aggregates, 200
 
-    return results_list, 200
 
 def get_event_stats():
+    def load():
+        session = DB_SESSION()
+
+        with DB_QUERY_TIME.time(query="stats"):
+            stats = session.get(EventStats, STATS_ID)
+
+        session.close()
+
+        if stats is None:
+            return { "num_enrolls": 0, "num_drop_outs": 0 }
+        return stats.to_dict()
+
+    return QUERY_CACHE.get_or_load(("stats",), load), 200
+
+
+
+def decode_message(raw_value):
+    """
+    Decodes a raw Kafka message value into an event dictionary
+
+    args:
+        bytes raw_value: the value of the Kafka message
+
+    returns:
+        dict: the decoded event, or None if the message is neither a binary
+            nor a JSON event
+
+    """
+    try:
+        return wire.decode(raw_value)
+    except ValueError as e:
+        logger.error("Skipping undecodable message: %s", e)
+        return None
+
+
+def enroll_row(payload, date_created):
+    """Builds an enroll table row from an enroll event payload"""
+    return {
+        "student_id": payload['student_id'],
+        "program": payload['program'],
+        "highschool_gpa": float(payload['highschool_gpa']),
+        "student_acceptance_date": datetime.strptime(payload['student_acceptance_date'], "%m-%d-%Y"),
+        "program_starting_date": datetime.strptime(payload['program_starting_date'], "%m-%d-%Y"),
+        "date_created": date_created,
+        "trace_id": payload['trace_id']
+    }
+
+
+def drop_out_row(payload, date_created):
+    """Builds a drop_out table row from a drop_out event payload"""
+    return {
+        "student_id": payload['student_id'],
+        "program": payload['program'],
+        "program_gpa": float(payload['program_gpa']),
+        "student_dropout_date": datetime.strptime(payload['student_dropout_date'], "%m-%d-%Y"),
+        "date_created": date_created,
+        "trace_id": payload['trace_id']
+    }
+
+
+def count_events(session, enroll_rows, drop_out_rows):
+    """
+    Adds a batch of rows to the event_stats and program_stats counters, in
+    the transaction that inserts the rows so the counters always match the
+    committed events. Each counter row is upserted, so the counters of a new
+    program are created by the first batch that has one.
+
+    args:
+        object session: the database session inserting the rows
+        list enroll_rows: the enroll rows of the batch
+        list drop_out_rows: the drop_out rows of the batch
+
+    returns:
+        None
+    """
+    totals = {
+        "id": STATS_ID,
+        "num_enrolls": len(enroll_rows),
+        "num_drop_outs": len(drop_out_rows),
+        "highschool_gpa_sum": sum(row['highschool_gpa'] for row in enroll_rows),
+        "program_gpa_sum": sum(row['program_gpa'] for row in drop_out_rows)
+    }
+    statement = upsert(EventStats).values(totals)
+    session.execute(statement.on_duplicate_key_update(
+        { column: getattr(EventStats, column) + statement.inserted[column]
+          for column in ("num_enrolls", "num_drop_outs", "highschool_gpa_sum", "program_gpa_sum") }))
+
+    programs = {}
+    for event_type, rows, gpa_field in (("enroll", enroll_rows, "highschool_gpa"),
+                                        ("drop_out", drop_out_rows, "program_gpa")):
+        for row in rows:
+            counts = programs.setdefault((event_type, row['program']), [0, 0])
+            counts[0] += 1
+            counts[1] += row[gpa_field]
+
+    add_program_stats(session, programs)
+
+
+def add_program_stats(session, programs):
+    """
+    Adds counts to the program_stats counters, creating the counters of new
+    programs. Upserting lets the database decide which program names are the
+    same counter, by the collation of the program column.
+
+    args:
+        object session: the database session to write with
+        dict programs: the [num_events, gpa_sum] to add by (event_type, program)
+    """
+    if not programs:
+        return
+    statement = upsert(ProgramStats).values([
+        { "event_type": event_type, "program": program, "num_events": num_events, "gpa_sum": gpa_sum }
+        for (event_type, program), (num_events, gpa_sum) in programs.items()])
+    session.execute(statement.on_duplicate_key_update(
+        num_events=ProgramStats.num_events + statement.inserted['num_events'],
+        gpa_sum=ProgramStats.gpa_sum + statement.inserted['gpa_sum']))
+
+
+def count_programs(session, last_ids, programs, after=False):
+    """
+    Counts the events and sums the GPAs of each program in the enroll and
+    drop_out tables, over the rows with ids up to last_ids, or after them
+
+    args:
+        object session: the database session to query with
+        dict last_ids: the last id of each event type
+        dict programs: the [num_events, gpa_sum] by (event_type, program) to add the counts to
+        bool after: True to count the rows after last_ids instead
+    """
+    for event_type, model, gpa_column in STATS_MODELS:
+        window = model.id > last_ids[event_type] if after else model.id <= last_ids[event_type]
+        rows = session.query(model.program, func.count(model.id), func.sum(gpa_column)).filter(window) \
+                      .group_by(model.program)
+        for program, num_events, gpa_sum in rows:
+            counts = programs.setdefault((event_type, program), [0, 0])
+            counts[0] += num_events
+            counts[1] += gpa_sum or 0
+
+
+def reconcile_stats():
+    """
+    Rebuilds the event_stats and program_stats counters from the enroll and
+    drop_out tables, correcting any drift, such as from rows changed outside
+    of Storage or stored before the counters existed.
+
+    The tables are counted without holding INSERT_LOCK, so the consumers keep
+    storing batches during the scans. The last ids are read under the lock,
+    when no batch is being inserted, so every row up to them is committed and
+    every row stored later has a greater id. Only the few rows stored during
+    the scans are then counted under the lock, in the transaction that
+    replaces the counters.
+
+    returns:
+        None
+    """
     session = DB_SESSION()
 
-    enroll_count = session.query(Enroll).count()
-    drop_out_count = session.query(DropOut).count()
+    try:
+        with INSERT_LOCK:
+            last_ids = { event_type: session.query(func.max(model.id)).scalar() or 0
+                         for event_type, model, _ in STATS_MODELS }
+        session.commit()
+
+        programs = {}
+        with DB_QUERY_TIME.time(query="reconcile_stats"):
+            count_programs(session, last_ids, programs)
+        session.commit()
+
+        with INSERT_LOCK:
+            count_programs(session, last_ids, programs, after=True)
+
+            totals = { "id": STATS_ID, "num_enrolls": 0, "num_drop_outs": 0,
+                       "highschool_gpa_sum": 0, "program_gpa_sum": 0 }
+            for (event_type, _), (num_events, gpa_sum) in programs.items():
+                if event_type == "enroll":
+                    totals['num_enrolls'] += num_events
+                    totals['highschool_gpa_sum'] += gpa_sum
+                else:
+                    totals['num_drop_outs'] += num_events
+                    totals['program_gpa_sum'] += gpa_sum
+            previous = session.get(EventStats, STATS_ID)
+            previous = previous.to_dict() if previous is not None else { "num_enrolls": 0, "num_drop_outs": 0 }
+
+            session.execute(delete(ProgramStats))
+            add_program_stats(session, programs)
+            session.execute(delete(EventStats))
+            session.execute(insert(EventStats), [totals])
+            session.commit()
+            DATA_VERSION.bump()
+    except Exception:
+        session.rollback()
+        raise
+    finally:
+        session.close()
 
-    session.close()
+    current = { "num_enrolls": totals['num_enrolls'], "num_drop_outs": totals['num_drop_outs'] }
+    if previous != current:
+        logger.warning("Rebuilt stats counters from %s to %s", previous, current)
+    else:
+        logger.info("Reconciled stats counters of %d enroll and %d drop_out events",
+                    totals['num_enrolls'], totals['num_drop_outs'])
 
-    return { "num_enrolls": enroll_count, "num_drop_outs": drop_out_count }, 200
 
+def reconcile_stats_periodically():
+    """Reconciles the stats counters on start up and then every reconcile_interval_sec"""
+    while True:
+        try:
+            reconcile_stats()
+        except Exception as e:
+            logger.error("Failed to reconcile stats counters: %s", e)
+        time.sleep(APP_CONFIG['stats']['reconcile_interval_sec'])
 
 
-def process_messages():
+def store_batch(events):
     """
-    Consumes messages from the Kafka broker and stores the events
-    in the enroll and drop_out tables in the database. 
-    
+    Stores a micro-batch of events with a single multi-row INSERT per table,
+    and adds them to the stats counters, all within one transaction.
+    Malformed events are logged and skipped so
+    they cannot block the rest of the batch.
+
+    args:
+        list events: the decoded Kafka messages in the batch
+
+    returns:
+        int: the number of enroll rows stored
+        int: the number of drop_out rows stored
+
+    raises:
+        Exception: if the transaction fails, after it has been rolled back
+
+    """
+    enroll_rows = []
+    drop_out_rows = []
+    date_created = datetime.now()
+
+    for event in events:
+        try:
+            if event['type'] == "enroll":
+                enroll_rows.append(enroll_row(event['payload'], date_created))
+            elif event['type'] == "drop_out":
+                drop_out_rows.append(drop_out_row(event['payload'], date_created))
+        except (KeyError, TypeError, ValueError) as e:
+            logger.error("Skipping malformed event %s: %s", event, e)
+
+    session = DB_SESSION()
+
+    try:
+        with INSERT_LOCK, DB_QUERY_TIME.time(query="insert_batch"):
+            if enroll_rows:
+                session.execute(insert(Enroll), enroll_rows)
+            if drop_out_rows:
+                session.execute(insert(DropOut), drop_out_rows)
+            if enroll_rows or drop_out_rows:
+                count_events(session, enroll_rows, drop_out_rows)
+            session.commit()
+            if enroll_rows or drop_out_rows:
+                DATA_VERSION.bump()
+    except Exception:
+        session.rollback()
+        raise
+    finally:
+        session.close()
+
+    return len(enroll_rows), len(drop_out_rows)
+
+
+def is_transient(error):
+    """Tells whether a database error may succeed on retry, such as a lost connection or a deadlock"""
+    return (isinstance(error, (OperationalError, InterfaceError))
+            or (isinstance(error, DBAPIError) and error.connection_invalidated))
+
+
+def flush_batch(consumer, batch):
+    """
+    Stores a batch of Kafka messages and commits the consumer offsets once
+    the batch is in the database. Transient database failures are retried so
+    offsets are never committed for events that were not stored
+    (at-least-once). When the database rejects the batch, such as for a GPA
+    or program name too large for its column, the batch is split in halves
+    until the rejected events are isolated; those are logged and skipped so
+    they cannot stall the partition.
+
+    args:
+        object consumer: the Kafka consumer the batch was read from
+        list batch: the Kafka messages in the batch
+
     returns:
         None
-        
+
+    """
+    events = []
+    for msg in batch:
+        event = decode_message(msg.value)
+        if event is not None:
+            payload_logger.debug("Message: %s", event)
+            events.append(event)
+
+    num_enrolls = num_drop_outs = 0
+    # Stack of the parts of the batch still to store, the next part last, so
+    # the parts are stored in order and each is only stored once
+    pending = [events]
+    while pending:
+        part = pending[-1]
+        try:
+            stored_enrolls, stored_drop_outs = store_batch(part)
+        except Exception as e:
+            if is_transient(e):
+                logger.error("Failed to store batch of %d events, retrying: %s", len(part), e)
+                time.sleep(APP_CONFIG['events']['retry_delay'])
+                continue
+
+            pending.pop()
+            if len(part) == 1:
+                logger.error("Skipping event rejected by the database %s: %s", part[0], e)
+                EVENTS_REJECTED.inc(event_type=part[0].get('type'))
+            else:
+                logger.error("Database rejected batch of %d events, splitting it: %s", len(part), e)
+                middle = len(part) // 2
+                pending.extend((part[middle:], part[:middle]))
+            continue
+
+        pending.pop()
+        num_enrolls += stored_enrolls
+        num_drop_outs += stored_drop_outs
+
+    consumer.commit_offsets()
+    BATCH_SIZE.observe(len(batch))
+    EVENTS_STORED.inc(num_enrolls, event_type="enroll")
+    EVENTS_STORED.inc(num_drop_outs, event_type="drop_out")
+    logger.info("Stored batch of %d enroll and %d drop_out events", num_enrolls, num_drop_outs)
+
+
+def process_messages(worker):
+    """
+    Consumes messages from the Kafka broker in micro-batches and stores the
+    events in the enroll and drop_out tables in the database. A batch is
+    flushed once it reaches the configured max size, once the oldest message
+    in it has waited max linger ms, or when the topic goes idle.
+
+    Each worker is a member of the balanced event_group consumer group, so
+    Kafka assigns it a share of the topic's partitions. Events are keyed by
+    student_id, so the events of a student are all stored by one worker, in
+    order.
+
+    args:
+        int worker: the number of the worker, for logging
+
+    returns:
+        None
+
     """
     hostname = "%s:%d" % (APP_CONFIG['events']['hostname'],
                         APP_CONFIG['events']['port'])
+    max_batch_size = APP_CONFIG['events']['batch']['max_size']
+    max_linger_ms = APP_CONFIG['events']['batch']['max_linger_ms']
 
     consumer = None
     max_retries = APP_CONFIG['events']['retries']
     current_retries = 0
     while current_retries < max_retries:
-        logger.info(f"Attempting to connect to Kafka broker: {current_retries} retries")
+        logger.info(f"Worker {worker} attempting to connect to Kafka broker: {current_retries} retries")
         try:
             client = KafkaClient(hosts=hostname)
             topic = client.topics[str.encode(APP_CONFIG['events']['topic'])]
-            consumer = topic.get_simple_consumer(consumer_group=b"event_group",
+            consumer = topic.get_balanced_consumer(consumer_group=b"event_group",
+                                managed=True, # group membership coordinated by Kafka
+                                auto_commit_enable=False, # offsets committed once a batch is stored
                                 reset_offset_on_start=False, # keep offset position
-                                auto_offset_reset=OffsetType.LATEST) # reset to latest if no offset
-            logger.info("Sucessfully connected to Kafka broker")
+                                auto_offset_reset=OffsetType.LATEST, # reset to latest if no offset
+                                consumer_timeout_ms=max_linger_ms) # wake up to flush partial batches
+            logger.info("Worker %d sucessfully connected to Kafka broker", worker)
             break
         except:
             logger.error("Kafka connection failed")
             time.sleep(APP_CONFIG['events']['retry_delay'])
             current_retries += 1
 
+    lag = ConsumerLag("event_group", APP_CONFIG['events']['lag_interval_sec'])
+    batch = []
+    batch_deadline = None
+    while True:
+        msg = consumer.consume()
+        lag.update(consumer)
 
-    for msg in consumer:
-        msg_str = msg.value.decode('utf-8')
-        msg = json.loads(msg_str)
-        logger.info("Message: %s", msg)
+        if msg is not None:
+            batch.append(msg)
+            if batch_deadline is None:
+                batch_deadline = time.monotonic() + max_linger_ms / 1000
 
-        try:
-            payload = msg['payload']
+        if not batch:
+            continue
 
-            if msg['type'] == "enroll":
-                logger.info("Storing enroll event to database")
-                enroll_student(payload)
-            elif msg['type'] == "drop_out":
-                logger.info("Storing drop_out event to database")
-                withdraw_student(payload)
+        if (msg is None or len(batch) >= max_batch_size
+                or time.monotonic() >= batch_deadline):
+            flush_batch(consumer, batch)
+            batch = []
+            batch_deadline = None
 
-            consumer.commit_offsets()
 
-        except Exception as e:
-            logger.error(f"Error: {e}")
 
+def start_background_tasks():
+    """Starts the stats reconciliation and Kafka consumer workers, in one worker process only"""
+    Thread(target=reconcile_stats_periodically, daemon=True).start()
+    for worker in range(APP_CONFIG['events']['consumer_workers']):
+        t1 = Thread(target=process_messages, args=(worker,))
+        t1.daemon = True
+        t1.start()
 
 
-app = connexion.FlaskApp(__name__, specification_dir='')
-app.add_api("openapi.yaml", base_path="/storage", strict_validation=True, validate_responses=True)
+app = connexion.FlaskApp(__name__, specification_dir='',
+                         lifespan=leader_lifespan(APP_CONFIG['server']['lock_file'], start_background_tasks))
+app.add_api("openapi.yaml", base_path="/storage", strict_validation=True, validate_responses=True,
+            validator_map=NDJSON_VALIDATOR_MAP)
+app.add_middleware(MetricsMiddleware, position=MiddlewarePosition.BEFORE_EXCEPTION, path="/storage/metrics",
+                   shared_dir=APP_CONFIG['server']['metrics_dir'])
 
 if __name__ == "__main__":
-    t1 = Thread(target=process_messages)
-    t1.setDaemon(True)
-    t1.start()
-    app.run(port=8090, host="0.0.0.0")
+    app.run(port=APP_CONFIG['server']['port'], host="0.0.0.0")
 
@@ -0,0 +1,105 @@
+import mmap
+import os
+import struct
+import threading
+import time
+from collections import OrderedDict
+
+from metrics import counter, gauge
+
+CACHE_REQUESTS = counter("cache_requests_total", "Query cache lookups", ["query", "result"])
+CACHE_EVICTIONS = counter("cache_evictions_total", "Query cache entries evicted to stay within max_entries")
+CACHE_ENTRIES = gauge("cache_entries", "Entries in the query cache")
+
+VERSION = struct.Struct("Q")
+
+
+class DataVersion:
+    """
+    A counter of the commits to the event tables, shared by the worker
+    processes serving the app through a memory mapped file. The worker
+    running the Kafka consumers bumps it after each commit, and every worker
+    reads it without a system call to tell whether its cached results are
+    still current.
+    """
+
+    def __init__(self, path):
+        fd = os.open(path, os.O_RDWR | os.O_CREAT, 0o644)
+        try:
+            if os.fstat(fd).st_size < VERSION.size:
+                os.ftruncate(fd, VERSION.size)
+            self.map = mmap.mmap(fd, VERSION.size)
+        finally:
+            os.close(fd)
+
+    def current(self):
+        return VERSION.unpack_from(self.map)[0]
+
+    def bump(self):
+        """Marks every cached result as stale. Only one thread may bump at a time."""
+        VERSION.pack_into(self.map, 0, self.current() + 1)
+
+
+class QueryCache:
+    """
+    Read-through cache of query results, bounded by both age and size. An
+    entry is served while it is younger than ttl seconds and the data version
+    has not changed since it was loaded; otherwise it is loaded again. When
+    the cache holds max_entries, the least recently used entry is evicted.
+    """
+
+    def __init__(self, version, ttl, max_entries, enabled=True):
+        """
+        args:
+            DataVersion version: the version of the data the queries read
+            float ttl: the most seconds an entry is served for
+            int max_entries: the most entries kept
+            bool enabled: False to always load
+        """
+        self.version = version
+        self.ttl = ttl
+        self.max_entries = max_entries
+        self.enabled = enabled
+        self.lock = threading.Lock()
+        self.entries = OrderedDict()
+
+    def get_or_load(self, key, load, cache_if=None):
+        """
+        Returns the cached result for key, or loads and caches it
+
+        args:
+            tuple key: the query and its arguments, starting with the query name
+            function load: runs the query and returns its result
+            function cache_if: given the result, returns False to not cache it,
+                such as for very large results
+
+        returns:
+            object: the result, shared with other callers so it must not be modified
+        """
+        if not self.enabled:
+            return load()
+
+        # The version is read before loading, so rows committed during the
+        # query leave the entry stale rather than cached as current
+        version = self.version.current()
+        now = time.monotonic()
+        with self.lock:
+            entry = self.entries.get(key)
+            if entry is not None and entry[0] == version and entry[1] > now:
+                self.entries.move_to_end(key)
+                CACHE_REQUESTS.inc(query=key[0], result="hit")
+                return entry[2]
+
+        CACHE_REQUESTS.inc(query=key[0], result="miss")
+        result = load()
+        if cache_if is not None and not cache_if(result):
+            return result
+
+        with self.lock:
+            self.entries[key] = (version, now + self.ttl, result)
+            self.entries.move_to_end(key)
+            while len(self.entries) > self.max_entries:
+                self.entries.popitem(last=False)
+                CACHE_EVICTIONS.inc()
+            CACHE_ENTRIES.set(len(self.entries))
+        return result
@@ -0,0 +1,22 @@
+import mysql.connector
+from app import APP_CONFIG
+
+
+# Adds the date_created keyset indexes to tables created before they were
+# part of create_tables_mysql.py
+db_conn = mysql.connector.connect(host=APP_CONFIG['datastore']['hostname'],
+                                  user=APP_CONFIG['datastore']['user'],
+                                  password=APP_CONFIG['datastore']['password'],
+                                  database=APP_CONFIG['datastore']['db'])
+
+db_cursor = db_conn.cursor()
+db_cursor.execute('''
+          CREATE INDEX ix_enroll_date_created_id ON enroll (date_created, id)
+          ''')
+
+db_cursor.execute('''
+          CREATE INDEX ix_drop_out_date_created_id ON drop_out (date_created, id)
+          ''')
+
+db_conn.commit()
+db_conn.close()
@@ -18,7 +18,8 @@ db_cursor.execute('''
             program_starting_date DATE NOT NULL,
             date_created DATETIME NOT NULL,
             trace_id VARCHAR(250) NOT NULL,
-            CONSTRAINT enroll_pk PRIMARY KEY (id)
+            CONSTRAINT enroll_pk PRIMARY KEY (id),
+            INDEX ix_enroll_date_created_id (date_created, id)
           )
           ''')
 
@@ -31,7 +32,29 @@ db_cursor.execute('''
             student_dropout_date DATE NOT NULL,
             date_created DATETIME NOT NULL,
             trace_id VARCHAR(250) NOT NULL,
-            CONSTRAINT drop_out_pk PRIMARY KEY (id)
+            CONSTRAINT drop_out_pk PRIMARY KEY (id),
+            INDEX ix_drop_out_date_created_id (date_created, id)
+          )
+          ''')
+
+db_cursor.execute('''
+          CREATE TABLE event_stats (
+            id INT NOT NULL,
+            num_enrolls BIGINT NOT NULL,
+            num_drop_outs BIGINT NOT NULL,
+            highschool_gpa_sum DECIMAL(14,2) NOT NULL,
+            program_gpa_sum DECIMAL(14,2) NOT NULL,
+            CONSTRAINT event_stats_pk PRIMARY KEY (id)
+          )
+          ''')
+
+db_cursor.execute('''
+          CREATE TABLE program_stats (
+            event_type VARCHAR(10) NOT NULL,
+            program VARCHAR(50) NOT NULL,
+            num_events BIGINT NOT NULL,
+            gpa_sum DECIMAL(14,2) NOT NULL,
+            CONSTRAINT program_stats_pk PRIMARY KEY (event_type, program)
           )
           ''')
 
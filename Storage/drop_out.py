@@ -1,4 +1,4 @@
-from sqlalchemy import Column, String, Integer, Numeric, Date, DateTime
+from sqlalchemy import Column, String, Integer, Numeric, Date, DateTime, Index
 from sqlalchemy.sql.functions import now
 from base import Base
 from datetime import datetime
@@ -6,6 +6,8 @@ from datetime import datetime
 class DropOut(Base):
 
     __tablename__ = "drop_out"
+    # Serves the date_created range scans and (date_created, id) keyset pagination
+    __table_args__ = (Index("ix_drop_out_date_created_id", "date_created", "id"),)
 
     id                      = Column(Integer, primary_key=True)
     student_id              = Column(String(250), nullable=False)
@@ -6,7 +6,7 @@ password="ROMRAMRemRam!", database="events")
 db_cursor = db_conn.cursor()
 
 db_cursor.execute('''
-                 DROP TABLE enroll, drop_out
+                 DROP TABLE enroll, drop_out, event_stats, program_stats
                  ''')
 
 db_conn.commit()
@@ -1,4 +1,4 @@
-from sqlalchemy import Column, Integer, String, Date, DateTime, Numeric
+from sqlalchemy import Column, Integer, String, Date, DateTime, Numeric, Index
 from sqlalchemy.sql.functions import now
 from base import Base
 from datetime import datetime
@@ -6,6 +6,8 @@ from datetime import datetime
 class Enroll(Base):
 
     __tablename__ = "enroll"
+    # Serves the date_created range scans and (date_created, id) keyset pagination
+    __table_args__ = (Index("ix_enroll_date_created_id", "date_created", "id"),)
 
     id                      = Column(Integer, primary_key=True)
     student_id              = Column(String(250), nullable=False)
@@ -0,0 +1,20 @@
+from sqlalchemy import Column, Integer, BigInteger, Numeric
+from base import Base
+
+class EventStats(Base):
+
+    __tablename__ = "event_stats"
+    # A single row of running totals, updated in the same transaction as
+    # every insert of events so /stats does not count the event tables
+
+    id                 = Column(Integer, primary_key=True, autoincrement=False)
+    num_enrolls        = Column(BigInteger, nullable=False)
+    num_drop_outs      = Column(BigInteger, nullable=False)
+    highschool_gpa_sum = Column(Numeric(14, 2), nullable=False)
+    program_gpa_sum    = Column(Numeric(14, 2), nullable=False)
+
+    def to_dict(self):
+        return {
+            "num_enrolls": self.num_enrolls,
+            "num_drop_outs": self.num_drop_outs
+        }
@@ -0,0 +1,46 @@
+import json
+
+from connexion.datastructures import MediaTypeDict
+from connexion.exceptions import NonConformingResponseBody
+from connexion.validators import VALIDATOR_MAP, JSONResponseBodyValidator
+
+
+class NDJSONResponseBodyValidator(JSONResponseBodyValidator):
+    """
+    Validates application/x-ndjson response bodies one line at a time as they
+    are streamed, instead of buffering the whole body like the JSON validator
+    """
+
+    def _validate_line(self, line):
+        if not line.strip():
+            return
+        try:
+            self._validate(json.loads(line.decode(self._encoding)))
+        except json.decoder.JSONDecodeError as e:
+            raise NonConformingResponseBody(str(e))
+
+    def wrap_send(self, send):
+        buffer = b""
+
+        async def send_(message):
+            nonlocal buffer
+            if message["type"] == "http.response.body":
+                buffer += message.get("body", b"")
+                *lines, buffer = buffer.split(b"\n")
+                for line in lines:
+                    self._validate_line(line)
+                if not message.get("more_body", False):
+                    self._validate_line(buffer)
+            await send(message)
+
+        return send_
+
+
+# Connexion's default validators with NDJSON added, so validate_responses
+# keeps streamed responses streaming
+NDJSON_VALIDATOR_MAP = {
+    "response": MediaTypeDict({
+        **VALIDATOR_MAP["response"],
+        "application/x-ndjson": NDJSONResponseBodyValidator
+    })
+}
@@ -0,0 +1,12 @@
+from sqlalchemy import Column, String, BigInteger, Numeric
+from base import Base
+
+class ProgramStats(Base):
+
+    __tablename__ = "program_stats"
+    # Running totals of each event type per program, updated with event_stats
+
+    event_type              = Column(String(10), primary_key=True)
+    program                 = Column(String(50), primary_key=True)
+    num_events              = Column(BigInteger, nullable=False)
+    gpa_sum                 = Column(Numeric(14, 2), nullable=False)
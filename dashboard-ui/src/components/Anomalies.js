@@ -6,25 +6,21 @@ function Anomalies({ anomalyType }) {
     const [isLoaded, setIsLoaded] = useState(false);
     const [error, setError] = useState(null);
 
-    const getAnomaly = () => {
-        fetch(`http://ec2-18-206-137-36.compute-1.amazonaws.com/anomalies/anomalies?anomaly_type=${anomalyType}`, {
-            method: "GET",
-            headers: {
-                "Content-Type": "application/json"
-            }
-        })
-        .then((response) => response.json())
-        .then((result) => {
-            setAnomaly(result[0]);
-            setIsLoaded(true);
-        })
-        .catch((err) => setError(err));
-    };
-
     useEffect(() => {
-        const intervalId = setInterval(getAnomaly, 4000);
-        return () => clearInterval(intervalId);
-    }, [getAnomaly]);
+        // Sends the latest anomaly of each type, then each new anomaly as an
+        // event named after its type
+        const source = new EventSource(`http://ec2-18-206-137-36.compute-1.amazonaws.com/anomalies/anomalies/stream`);
+        source.addEventListener(anomalyType, (event) => {
+            setAnomaly(JSON.parse(event.data));
+            setIsLoaded(true);
+        });
+        source.onerror = (err) => {
+            if (source.readyState === EventSource.CLOSED) {
+                setError(err);
+            }
+        };
+        return () => source.close();
+    }, [anomalyType]);
 
     if (error){
         return (<div className={"error"}>Error found when fetching from API</div>)
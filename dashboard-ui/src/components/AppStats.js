@@ -7,23 +7,24 @@ export default function AppStats() {
     const [stats, setStats] = useState({});
     const [error, setError] = useState(null)
 
-    const getStats = () => {
-	
-        fetch(`http://ec2-18-206-137-36.compute-1.amazonaws.com/processing/stats`)
-            .then(res => res.json())
-            .then((result)=>{
-				console.log("Received Stats")
-                setStats(result);
-                setIsLoaded(true);
-            },(error) =>{
+    useEffect(() => {
+        // The first event has every stat, later events only the stats that changed
+        const source = new EventSource(`http://ec2-18-206-137-36.compute-1.amazonaws.com/processing/stats/stream`);
+        source.addEventListener("stats", (event) => {
+            console.log("Received Stats")
+            const changed = JSON.parse(event.data);
+            setStats((stats) => ({ ...stats, ...changed }));
+            setIsLoaded(true);
+        });
+        source.onerror = (error) => {
+            // EventSource reconnects by itself unless the stream is closed for good
+            if (source.readyState === EventSource.CLOSED) {
                 setError(error)
                 setIsLoaded(true);
-            })
-    }
-    useEffect(() => {
-		const interval = setInterval(() => getStats(), 2000); // Update every 2 seconds
-		return() => clearInterval(interval);
-    }, [getStats]);
+            }
+        };
+        return () => source.close();
+    }, []);
 
     if (error){
         return (<div className={"error"}>Error found when fetching from API</div>)
@@ -1,14 +1,16 @@
 import React, { useEffect, useState } from 'react'
 import '../App.css';
 
+const COUNT_FIELDS = { "enroll": "num_enrolls", "drop-out": "num_drop_outs" };
+
 export default function EndpointAnalyzer(props) {
     const [isLoaded, setIsLoaded] = useState(false);
     const [log, setLog] = useState(null);
     const [error, setError] = useState(null)
     const [index, setIndex] = useState(null);
-    const rand_val = Math.floor(Math.random() * 100); // Get a random event from the event store
 
-    const getAnalyzer = () => {
+    const getAnalyzer = (count) => {
+        const rand_val = Math.floor(Math.random() * Math.min(count, 100)); // Get a random event from the event store
         fetch(`http://ec2-18-206-137-36.compute-1.amazonaws.com/analyzer/university-student-retention/${props.endpoint}?index=${rand_val}`)
             .then(res => res.json())
             .then((result)=>{
@@ -22,9 +24,25 @@ export default function EndpointAnalyzer(props) {
             })
     }
 	useEffect(() => {
-		const intervalId = setInterval(() => getAnalyzer(), 4000); // Update every 4 seconds
-		return() => clearInterval(intervalId);
-    }, [getAnalyzer]);
+        // Fetch a new random event only when events of this type arrive
+        const counts = {};
+        const field = COUNT_FIELDS[props.endpoint];
+        const source = new EventSource(`http://ec2-18-206-137-36.compute-1.amazonaws.com/analyzer/stats/stream`);
+        source.addEventListener("stats", (event) => {
+            const changed = JSON.parse(event.data);
+            Object.assign(counts, changed);
+            if (field in changed && counts[field] > 0) {
+                getAnalyzer(counts[field]);
+            }
+        });
+        source.onerror = (error) => {
+            if (source.readyState === EventSource.CLOSED) {
+                setError(error)
+                setIsLoaded(true);
+            }
+        };
+		return() => source.close();
+    }, [props.endpoint]);
 
     if (error){
         return (<div className={"error"}>Error found when fetching from API</div>)